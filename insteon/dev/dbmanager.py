@@ -2,10 +2,15 @@ import datetime
 
 from .linkdb import LinkDB,LinkRecord
 from . import linkdb
+from . import linkplan
+from .linkstore import LinkStore
+from .linkgraph import LinkGraph
+from .linkplan import PlanStep
 from ..util import InsteonError
 from ..io.address import Address
+from ..io.message import MsgType
 
-import time
+import asyncio
 
 import logbook
 logger = logbook.Logger(__name__)
@@ -16,13 +21,27 @@ class DBManager:
         self._dev = dev
 
     # Will update/return the target db,
-    # create a new database if None
-    async def update_cache(self, targetdb=None, allow_linking=False, port=None):
+    # create a new database if None.
+    # If incremental is set and the target db has been populated before
+    # the device's change counter is checked first, and the read is skipped
+    # (or limited to the end of the database) if the changes allow it
+    async def update_cache(self, targetdb=None, allow_linking=False, port=None, incremental=True):
         port = port if port else self._dev.port
 
         if not targetdb:
             targetdb = self.cache
 
+        delta = None
+        if incremental and targetdb.valid and targetdb.delta is not None:
+            delta = await self._retrieve_delta(port)
+            if delta is not None and await self._refresh(port, targetdb, delta):
+                self._store(targetdb)
+                return targetdb
+        elif incremental:
+            # Record the counter from before the read so
+            # any changes made during it are picked up next time
+            delta = await self._retrieve_delta(port)
+
         # _retrieve() returns a LinkDB() object
         records = await self._retrieve(port)
         # check if based on the retrieved
@@ -37,11 +56,62 @@ class DBManager:
             if not self._check_permissions(records):
                 raise InsteonError('Failed to get permission to modify the database')
 
+        records.delta = delta
         targetdb.update(records)
+        self._store(targetdb)
 
         return targetdb
 
-    async def flash_cache(self, srcdb=None, allow_linking=False, port=None):
+    # Keeps the store and link graph (if bound) in sync with the cache
+    def _store(self, db, kind='cache'):
+        store = LinkStore.bound()
+        if store and (db is self.cache or kind != 'cache'):
+            store.save(self._dev.address, db, kind)
+        graph = LinkGraph.bound()
+        if graph and db is self.cache:
+            graph.update(self._dev.address, db)
+
+    # Brings a populated db up to date given the device's
+    # current delta, returns False if a full read is needed
+    async def _refresh(self, port, db, delta):
+        if delta == db.delta:
+            logger.debug('Database of {} unchanged (delta {:02x})', self._dev.address, delta)
+            db.set_timestamp()
+            return True
+
+        # Most changes are new links which get written
+        # at the end, so have a look at just the end first
+        start = db.end_offset
+        tail = await self._retrieve(port, start)
+        if tail is None or tail.empty:
+            return False
+
+        changed = 0
+        for r in tail:
+            old = db.at(r.offset)
+            if not old or old.bytes != r.bytes:
+                changed += 1
+
+        # Each write bumps the counter by one, if there were more
+        # writes than changes at the end something else was changed too
+        writes = (delta - db.delta) & 0xFF
+        if writes > changed:
+            logger.debug('Database of {} changed outside of the end, reading everything',
+                            self._dev.address)
+            return False
+
+        for r in list(db):
+            if r.offset is not None and r.offset <= start:
+                db.remove(r)
+        for r in tail:
+            db.add(r)
+        db.delta = delta
+        db.set_timestamp()
+        return True
+
+    # Returns the plan of edits that were made, with dry_run
+    # the plan is only worked out and nothing is written
+    async def flash_cache(self, srcdb=None, allow_linking=False, port=None, dry_run=False):
         port = port if port else self._dev.port
 
         if not srcdb:
@@ -59,14 +129,46 @@ class DBManager:
         # Retrieve the current DB into a "currentdb" variable
         await self.update_cache(targetdb=currentdb, allow_linking=allow_linking, port=port)
 
-        # Save the currentdb
-        backfile_name = '{}.linkdb.bk'.format(datetime.datetime.now().strftime('%b_%d_%Y_%H:%M:%S'))
+        plan = self.plan(srcdb, currentdb)
+        if dry_run:
+            return plan
 
-        logger.warning('Modifying Link Database. This can go catastrophically wrong. A backup of the current database has been written to {}', backfile_name)
-        currentdb.save(backfile_name)
+        # Save the currentdb, into the store's history if there is one
+        if LinkStore.bound():
+            self._store(currentdb, 'backup')
+            logger.warning('Modifying Link Database. This can go catastrophically wrong. A backup of the current database has been saved to the link store')
+        else:
+            backfile_name = '{}.linkdb.bk'.format(datetime.datetime.now().strftime('%b_%d_%Y_%H:%M:%S'))
+
+            logger.warning('Modifying Link Database. This can go catastrophically wrong. A backup of the current database has been written to {}', backfile_name)
+            currentdb.save(backfile_name)
 
         logger.trace('Writing linkdb changes')
-        await self._write(port, srcdb, currentdb)
+        await self.apply_plan(plan, port)
+        return plan
+
+    # Works out the edits needed to turn currentdb into srcdb
+    def plan(self, srcdb, currentdb):
+        return linkplan.LinkPlan()
+
+    # Carries out a plan from plan(), which has to have been made
+    # against what is currently on the device
+    async def apply_plan(self, plan, port=None):
+        port = port if port else self._dev.port
+        steps, unlinks = self._split_unlinks(plan)
+        for step in steps:
+            await self._apply_step(port, step)
+        await self._verify(port, steps)
+        for step in unlinks:
+            await self._apply_step(port, step)
+
+    # The temporary modem link is what lets us at the database of
+    # i2CS devices, so everything is verified before it is removed
+    # (and removing it isn't verified), returns (steps, unlink steps)
+    def _split_unlinks(self, plan):
+        steps = [s for s in plan if s.action != PlanStep.MODEM_UNLINK]
+        unlinks = [s for s in plan if s.action == PlanStep.MODEM_UNLINK]
+        return steps, unlinks
 
     # Checks if the db has the permissions for
     # us to read
@@ -75,19 +177,29 @@ class DBManager:
 
     # Makes a database writable if the permission
     # check fails
-    def _grant_permissions(self, allow_linking):
+    async def _grant_permissions(self, allow_linking):
         return True
 
     # The actual implementation
     # that returns a database
-    # retrieved
-    async def _retrieve(self, port):
+    # retrieved, if start is given only the records
+    # from that offset onwards need to be read
+    # (and only count of them, if count is given)
+    async def _retrieve(self, port, start=None, count=0):
         pass
 
-    # The actual implementation that writes
-    # a database given a current database and
-    # a source database to write
-    async def _write(self, port, srcdb, currentdb):
+    # Returns the database change counter of the device,
+    # None if the device doesn't have one
+    async def _retrieve_delta(self, port):
+        return None
+
+    # The actual implementation that carries
+    # out a single step of a plan
+    async def _apply_step(self, port, step):
+        pass
+
+    # Checks the steps of an applied plan took
+    async def _verify(self, port, plan):
         pass
 
 
@@ -111,7 +223,7 @@ class GenericDBManager(DBManager):
             return True
         return False
 
-    def _grant_permissions(self, allow_linking):
+    async def _grant_permissions(self, allow_linking):
         if not allow_linking:
             return False
         # Link these things, check if there is a linker
@@ -123,163 +235,168 @@ class GenericDBManager(DBManager):
         logger.debug('Linking modem {} as controller to {}'.format(self._dev.modem.address,
                                                                     self._dev.address))
 
-        self._dev.modem.linker.start_linking_controller()
-        time.sleep(0.1) # Put a little sleep in there
-        self._dev.linker.start_linking_responder()
-        time.sleep(1) # Put a little sleep in there so the device has time to change its db
+        await self._dev.modem.linker.start_linking_controller()
+        await asyncio.sleep(0.1) # Put a little sleep in there
+        await self._dev.linker.start_linking_responder()
+        await asyncio.sleep(1) # Put a little sleep in there so the device has time to change its db
         return True
 
-    def _retrieve(self, port):
-        querier = self._dev.querier
-
-        record_channel = Channel(lambda x: x.type == 'ExtendedMessageReceived' and \
-                                            x['Cmd'] == 0x51 and \
-                                            x['fromAddress'] == self._dev.address)
-        response_channel = querier.query_ext(0x2f, 0x00, [], extra_channels=[record_channel])
-
-        if not response_channel.recv(1):
-            raise InsteonError('Did not get reply from device')
+    # The ALL-Link database delta comes back as
+    # command1 of the ACK to a status request
+    async def _retrieve_delta(self, port):
+        msg = self._dev.querier.create_std(0x19, 0x00, port=port)
+        with port.write(msg) as req:
+            if not await req.wait_success_fail(timeout=2):
+                return None
+            ack = await req.wait_until(lambda m: m.type == 'StandardMessageReceived' and \
+                                            m['fromAddress'] == self._dev.address and \
+                                            MsgType.from_msg(m) == MsgType.ACK_OF_DIRECT, timeout=4)
+        if not ack:
+            return None
+        return ack['command1']
+
+    async def _retrieve(self, port, start=None, count=0):
+        # Read from the start offset (0x0000 meaning the beginning)
+        # with a record count of 0 meaning all of them
+        data = [0x00, 0x00]
+        if start is not None or count:
+            start = start if start is not None else 0x0000
+            data.extend([(start >> 8) & 0xFF, start & 0xFF, count])
+        msg = self._dev.querier.create_ext(0x2f, 0x00, data, port=port)
 
         db = linkdb.LinkDB()
+        with port.write(msg) as req:
+            if not await req.wait_success_fail(timeout=2):
+                raise InsteonError('Did not get reply from device')
+
+            # Now keep receiving records until the end
+            while True:
+                msg = await req.wait_until(lambda x: x.type == 'ExtendedMessageReceived' and \
+                                                x['fromAddress'] == self._dev.address and \
+                                                x['command1'] == 0x2f, timeout=5)
+                if not msg:
+                    raise InsteonError('Database read from {} stopped after {} records'.format(
+                                            self._dev.address, db.size))
+                req.consume(msg)
 
-        # Now keep receiving on the record channel until none are left
-        while record_channel.wait(5):
-            msg = record_channel.recv(5)
-            offset = (msg['userData3'] & 0xFF) << 8 | (msg['userData4'] & 0xFF)
-            flags = msg['userData6'] & 0xFF 
-            group = msg['userData7'] & 0xFF
-            address = Address(msg['userData8'], msg['userData9'], msg['userData10'])
-            data = [msg['userData11'], msg['userData12'], msg['userData13']] 
+                offset = (msg['userData3'] & 0xFF) << 8 | (msg['userData4'] & 0xFF)
+                flags = msg['userData6'] & 0xFF 
+                group = msg['userData7'] & 0xFF
+                address = Address(msg['userData8'], msg['userData9'], msg['userData10'])
+                data = [msg['userData11'], msg['userData12'], msg['userData13']] 
 
-            if not linkdb.LinkRecord(offset=offset) in db:
-                db.add(linkdb.LinkRecord(offset, address, group, flags, data))
+                record = linkdb.LinkRecord(offset, address, group, flags, data)
+                if not linkdb.LinkRecord(offset=offset) in db:
+                    db.add(record)
+                if (record.null and not count) or (count and db.size >= count):
+                    break
 
         return db
 
-    def _write_entry(self, offset, record):
-        record = record.copy()
-        record.offset = None
-        logger.debug('Writing record to {:04x}: {}'.format(offset, record))
-        req_data = [0x00, 0x02]
-        req_data.append((offset >> 8) & 0xFF)
-        req_data.append(offset & 0xFF)
-        req_data.append(8) # Set 8 bytes
-
-        record_bytes = record.bytes
+    # The bytes a step leaves at its offset
+    def _step_bytes(self, step):
+        if step.action == PlanStep.END or \
+                (step.action == PlanStep.MODEM_UNLINK and not step.record):
+            return 8*[0x00] # null out the entry
+        record_bytes = step.record.bytes
         # Make sure if nothing else that the high water
         # bit is set. If it isn't we could really brick the device
         record_bytes[0] = record_bytes[0] | 0x10
-        req_data.extend(record_bytes)
-        self._dev.querier.query_ext(0x2f, 0x00, req_data)
-        time.sleep(1)
+        return record_bytes
 
-    def _null_entry(self, offset):
-        logger.debug('Setting database end at {:04x}'.format(offset))
+    # The 0x2f payload writing 8 bytes at an offset
+    def _write_data(self, offset, record_bytes):
         req_data = [0x00, 0x02]
         req_data.append((offset >> 8) & 0xFF)
         req_data.append(offset & 0xFF)
         req_data.append(8) # Set 8 bytes
-        req_data.extend(8*[0x00]) # null out the entry
-        self._dev.querier.query_ext(0x2f, 0x00, req_data)
-        time.sleep(1)
-
-    def _write(self, port, srcdb, currentdb):
-        # When nuking a database unlink the modem last
-        modem_addr = self._dev.modem.address
-
-        delete_records = []
-        for record in currentdb:
-            if not record.active:
-                continue
-            filter_rec = record.copy()
-            filter_rec.offset = None # We don't care about offset
-            if any(map(lambda x: x.offset < record.offset and filter_rec.matches(x), currentdb)):
-                logger.debug('Found dup  record: {}'.format(record))
-                delete_records.append(record)
-            elif not filter_rec in srcdb:
-                logger.debug('Found del  record: {}'.format(record))
-                delete_records.append(record)
-
-
-        free_records = list(delete_records)
-        for record in currentdb:
-            if not record.active:
-                logger.debug('Found free record: {}'.format(record))
-                free_records.append(record)
-                if record.null:
-                    # Append a bunch of dummy records after
-                    for i in range(srcdb.size):
-                        if record.offset - (i + 1) * 0x08 > 0x08:
-                            free_records.append(LinkRecord(offset=record.offset - (i + 1)*0x08))
-
-        logger.trace('Writing new records')
-
-        # if the modem is being removed, add the modem at the first free offset temporarily
-        modem_record = LinkRecord(address=modem_addr)
-        modem_record.mask_link_type()
-        modem_record.mask_active()
-        modem_record.active = True
-        modem_record.controller = False
-        modem_record.high_water = False
-
-        modem_offset = None
-        if any(map(lambda x: modem_record.matches(x), delete_records)):
-            if len(free_records) == 0:
-                raise InsteonError('Out of database space!')
-            modem_offset = free_records.pop(0).offset
-            logger.trace('Writing modem record for editing into first free space')
-            self._write_entry(modem_offset, modem_record)
-
-        # Write any new entries into the free
-        # spaces
-        for record in srcdb:
-            if not record.active:
-                continue
-            filter_rec = record.copy()
-            filter_rec.offset = None # We don't care about offset
-            if not filter_rec in currentdb:
-                if len(free_records) == 0:
-                    raise InsteonError('Out of database space!')
-                free_offset = free_records.pop(0).offset
-                self._write_entry(free_offset, record)
-
-        logger.trace('Fetching fresh copy of database')
-        currentdb = linkdb.LinkDB()
-        self.update_cache(targetdb=currentdb, port=port)
-
-        logger.trace('Disabling inactive records')
-
-        # Disable anything that shouldn't be in the database
-        for record in currentdb:
-            if not record.active:
+        req_data.extend(record_bytes)
+        return req_data
+
+    async def _write_entry(self, port, offset, record_bytes):
+        msg = self._dev.querier.create_ext(0x2f, 0x00, self._write_data(offset, record_bytes), port=port)
+        await self._send_write(port, offset, msg)
+
+    # Sends a write built by _write_data(), the device ACKs once
+    # it has written the record so no need to wait any longer than that
+    async def _send_write(self, port, offset, msg, retries=2):
+        for _ in range(retries + 1):
+            with port.write(msg) as req:
+                if not await req.wait_success_fail(timeout=2):
+                    continue
+                ack = await req.wait_until(lambda m: m.type == 'StandardMessageReceived' and \
+                                                m['fromAddress'] == self._dev.address and \
+                                                m['command1'] == 0x2f and \
+                                                MsgType.from_msg(m) in (MsgType.ACK_OF_DIRECT,
+                                                                        MsgType.NACK_OF_DIRECT), timeout=3)
+            if not ack:
+                logger.debug('No ACK for write to {:04x}, resending', offset)
                 continue
-            if any(map(lambda x: record.matches(x), delete_records)):
-                if modem_offset and record.offset == modem_offset:
-                    continue # We'll handle this one at the end 
-                new_record = record.copy()
-                new_record.active = False
-                self._write_entry(new_record.offset, new_record)
-
-        logger.trace('Fetching fresh copy of database')
-        currentdb = linkdb.LinkDB()
-        self.update_cache(targetdb=currentdb, port=port)
-        logger.trace('Setting end to null entry')
+            if MsgType.from_msg(ack) == MsgType.NACK_OF_DIRECT:
+                raise InsteonError('Device {} refused write to {:04x}'.format(self._dev.address, offset))
+            return
+        raise InsteonError('Device {} did not acknowledge write to {:04x}'.format(self._dev.address, offset))
+
+    # Reads back only what the plan wrote, a contiguous run
+    # of offsets at a time, and rewrites anything that didn't stick
+    async def _verify(self, port, plan, retries=2):
+        expected = {}
+        for step in plan:
+            expected[step.offset] = self._step_bytes(step)
+        if not expected:
+            return
+
+        for _ in range(retries + 1):
+            runs = []
+            for offset in sorted(expected, reverse=True):
+                if runs and runs[-1][-1] - 0x08 == offset:
+                    runs[-1].append(offset)
+                else:
+                    runs.append([offset])
+
+            bad = []
+            for run in runs:
+                readback = await self._retrieve(port, run[0], len(run))
+                for offset in run:
+                    rec = readback.at(offset)
+                    if not rec or rec.bytes != expected[offset]:
+                        bad.append(offset)
+            if not bad:
+                return
+
+            logger.warning('{} records on {} did not verify, rewriting', len(bad), self._dev.address)
+            for offset in bad:
+                await self._write_entry(port, offset, expected[offset])
+            expected = {o: expected[o] for o in bad}
+        raise InsteonError('Could not verify database writes at {}'.format(
+                                ', '.join('{:04x}'.format(o) for o in sorted(expected))))
+
+    def plan(self, srcdb, currentdb):
+        return linkplan.plan_device(currentdb, srcdb, self._dev.modem.address)
+
+    # Builds every write of the plan up front
+    async def apply_plan(self, plan, port=None):
+        port = port if port else self._dev.port
+        steps, unlinks = self._split_unlinks(plan)
+        msgs = self._dev.querier.create_ext_many(0x2f, 0x00,
+                    [self._write_data(s.offset, self._step_bytes(s)) for s in steps + unlinks], port=port)
+        for step, msg in zip(steps, msgs):
+            self._log_step(step)
+            await self._send_write(port, step.offset, msg)
+        await self._verify(port, steps)
+        for step, msg in zip(unlinks, msgs[len(steps):]):
+            self._log_step(step)
+            await self._send_write(port, step.offset, msg)
 
-        # Chop off after the end
-        self._null_entry(currentdb.end_offset)
+    def _log_step(self, step):
+        if step.record:
+            logger.debug('Writing record to {:04x}: {}', step.offset, step.record)
+        else:
+            logger.debug('Setting database end at {:04x}', step.offset)
 
-        if modem_offset:
-            logger.trace('Fetching fresh copy of database')
-            currentdb = linkdb.LinkDB()
-            self.update_cache(targetdb=currentdb, port=port)
-            logger.trace('Disabling modem record')
-            # If the modem is the last record, just wipe the database
-            if modem_offset == currentdb.end_offset - 0x08:
-                self._null_entry(modem_offset)
-            else:
-                new_record = currentdb.at(modem_offset).copy()
-                new_record.active = False
-                self._write_entry(new_record.offset, new_record)
+    async def _apply_step(self, port, step):
+        self._log_step(step)
+        await self._write_entry(port, step.offset, self._step_bytes(step))
 
 
 
@@ -287,7 +404,7 @@ class ModemDBManager(DBManager):
     def __init__(self, dev):
         super().__init__(dev)
 
-    async def _retrieve(self, port):
+    async def _retrieve(self, port, start=None, count=0):
         records = []
         first = True
         while True:
@@ -314,55 +431,32 @@ class ModemDBManager(DBManager):
 
         return db
 
-    def _write(self, port, srcdb, currentdb):
-        for record in currentdb:
-            filter_rec = record.copy()
-            filter_rec.offset = None
-            # If we do not find this record (regardless of offset) in the source
-            # database, delete it!
-            if not filter_rec in srcdb:
-                logger.debug('Deleting record {}', record)
-
-                msg = port.defs['ManageALLLinkRecord'].create()
-                msg['controlCode'] = 0x80 # Delete by search
-                msg['recordFlags'] = record.flags
-                msg['ALLLinkGroup'] = record.group
-                msg['linkAddress'] = record.address
-                msg['linkData1'] = record.data[0]
-                msg['linkData2'] = record.data[1]
-                msg['linkData2'] = record.data[2]
-
-                # Send the delete message and wait for a response
-                ack_reply = Channel()
-                port.write(msg, ack_reply_channel=ack_reply)
-                reply_msg = ack_reply.recv(2)
-                if reply_msg['ACK/NACK'] != 0x06:
+    def plan(self, srcdb, currentdb):
+        return linkplan.plan_modem(currentdb, srcdb)
+
+    async def _apply_step(self, port, step):
+        record = step.record
+        msg = port.defs['ManageALLLinkRecord'].create()
+        if step.action == PlanStep.DELETE:
+            logger.debug('Deleting record {}', record)
+            msg['controlCode'] = 0x80 # Delete by search
+        else:
+            logger.debug('Adding record {}', record)
+            # Add resp. or controller
+            msg['controlCode'] = 0x40 if (record.flags & (1 << 6)) else 0x41
+        msg['recordFlags'] = record.flags
+        msg['ALLLinkGroup'] = record.group
+        msg['linkAddress'] = record.address
+        msg['linkData1'] = record.data[0]
+        msg['linkData2'] = record.data[1]
+        msg['linkData3'] = record.data[2]
+
+        # Send the message and wait for a response
+        with port.write(msg) as req:
+            reply_msg = await req.wait_success_fail(timeout=2)
+            if not reply_msg:
+                raise InsteonError('No reply to {} message'.format(step.action))
+            elif reply_msg['ACK/NACK'] != 0x06:
+                if step.action == PlanStep.DELETE:
                     raise InsteonError('The modem couldn\'t find the record we wanted to delete!')
-                elif not reply_msg:
-                    raise InsteonError('No reply to delete message')
-
-        try:
-            currentdb = linkdb.LinkDB()
-            self.update_cache(targetdb=currentdb, port=port)
-        except InsteonError as e:
-            raise InsteonError('Unable to get database after removing records!') from e
-
-        for record in srcdb:
-            filter_rec = record.copy()
-            filter_rec.offset = None
-            if not filter_rec in currentdb:
-                logger.debug('Adding record {}', record)
-                msg = port.defs['ManageALLLinkRecord'].create()
-                # Add resp. or controller
-                msg['controlCode'] = 0x40 if (record.flags & (1 << 6)) else 0x41
-                msg['recordFlags'] = record.flags
-                msg['ALLLinkGroup'] = record.group
-                msg['linkAddress'] = record.address
-                msg['linkData1'] = record.data[0]
-                msg['linkData2'] = record.data[1]
-                msg['linkData3'] = record.data[2]
-
-                ack_reply = Channel()
-                port.write(msg, ack_reply_channel=ack_reply)
-                if not ack_reply.wait(2):
-                    raise InsteonError('No reply on record add!')
+                raise InsteonError('The modem couldn\'t add the record!')
@@ -0,0 +1,175 @@
+import asyncio
+import datetime
+
+from ..util import InsteonError
+
+import logbook
+logger = logbook.Logger(__name__)
+
+"""
+Refreshes the link databases of many devices at once through one Port.
+
+Up to concurrency devices are read at the same time. Their 0x2f record
+streams are interleaved on the powerline, the port only serializes the
+requests themselves, so a house full of devices takes about as long as
+its slowest few rather than the sum of all of them.
+
+Every device gets retries extra attempts (with a growing delay between
+them, during which its slot goes to another device). A device that still
+fails does not stop the rest, run() returns whatever was read and the
+failures are left in the per-device progress.
+"""
+
+class RefreshProgress:
+    PENDING = 'pending'
+    RUNNING = 'running'
+    RETRYING = 'retrying'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, device):
+        self.device = device
+        self.state = RefreshProgress.PENDING
+        self.attempts = 0
+        self.records = 0 # Records received during the current attempt
+        self.error = None
+        self.db = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def address(self):
+        return self.device.address
+
+    @property
+    def finished_ok(self):
+        return self.state == RefreshProgress.DONE
+
+    def __str__(self):
+        error = ' ({})'.format(self.error) if self.error else ''
+        return '{} {:8s} attempt {} records {}{}'.format(self.address.human, self.state,
+                                                          self.attempts, self.records, error)
+
+class DBRefresh:
+    # progress, if given, is called with the RefreshProgress
+    # of a device every time anything about it changes
+    def __init__(self, devices, port=None, concurrency=4, retries=2, retry_delay=2,
+                        incremental=True, allow_linking=False, progress=None):
+        self._devices = [d for d in devices if hasattr(d, 'db')]
+        if port is None and self._devices:
+            port = self._devices[0].port
+        self.port = port
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.incremental = incremental
+        self.allow_linking = allow_linking
+
+        self._progress_handlers = [progress] if progress else []
+        self._progress = {d.address: RefreshProgress(d) for d in self._devices}
+
+    def notify_progress(self, h):
+        self._progress_handlers.append(h)
+
+    def stop_notify_progress(self, h):
+        self._progress_handlers.remove(h)
+
+    def progress(self, address=None):
+        if address is not None:
+            return self._progress.get(address)
+        return list(self._progress.values())
+
+    # Databases read so far, by device address
+    @property
+    def results(self):
+        return {a: p.db for a, p in self._progress.items() if p.finished_ok}
+
+    @property
+    def failed(self):
+        return {a: p.error for a, p in self._progress.items()
+                    if p.state == RefreshProgress.FAILED}
+
+    @property
+    def done(self):
+        return all(p.state in (RefreshProgress.DONE, RefreshProgress.FAILED)
+                        for p in self._progress.values())
+
+    def print(self):
+        for p in self._progress.values():
+            print(p)
+
+    def _changed(self, p):
+        for h in list(self._progress_handlers):
+            h(p)
+
+    def _on_read(self, msg):
+        if msg.type != 'ExtendedMessageReceived' or msg['command1'] != 0x2f:
+            return
+        p = self._progress.get(msg['fromAddress'])
+        if p and p.state == RefreshProgress.RUNNING:
+            p.records += 1
+            self._changed(p)
+
+    async def _refresh(self, p, slots):
+        while True:
+            async with slots:
+                p.state = RefreshProgress.RUNNING
+                p.attempts += 1
+                p.records = 0
+                if not p.started:
+                    p.started = datetime.datetime.now()
+                self._changed(p)
+                try:
+                    p.db = await p.device.db.update_cache(allow_linking=self.allow_linking,
+                                                          port=self.port,
+                                                          incremental=self.incremental)
+                    p.state = RefreshProgress.DONE
+                    p.error = None
+                except (InsteonError, asyncio.TimeoutError) as e:
+                    p.error = e
+                    if p.attempts > self.retries:
+                        p.state = RefreshProgress.FAILED
+                        logger.warning('Giving up on database of {}: {}', p.address, e)
+                    else:
+                        p.state = RefreshProgress.RETRYING
+                        logger.debug('Database read of {} failed, retrying: {}', p.address, e)
+                except Exception as e:
+                    # Not something trying again would fix, but it's only
+                    # this device that failed, not the whole refresh
+                    p.error = e
+                    p.state = RefreshProgress.FAILED
+                    logger.exception('Reading the database of {} failed', p.address)
+            if p.state != RefreshProgress.RETRYING:
+                p.finished = datetime.datetime.now()
+                self._changed(p)
+                return
+            self._changed(p)
+            # Wait outside of the slot so another device can use it
+            await asyncio.sleep(self.retry_delay * 2**(p.attempts - 1))
+
+    # Refreshes every device that isn't done yet (so calling run()
+    # again after failures only retries the failed ones).
+    # Returns the databases that were read, by device address
+    async def run(self):
+        todo = [p for p in self._progress.values() if not p.finished_ok]
+        for p in todo:
+            p.state = RefreshProgress.PENDING
+            p.attempts = 0
+            p.error = None
+
+        slots = asyncio.Semaphore(self.concurrency)
+        self.port.notify_read(self._on_read)
+        try:
+            await asyncio.gather(*[self._refresh(p, slots) for p in todo])
+        finally:
+            self.port.stop_notify_read(self._on_read)
+
+        if self.failed:
+            logger.warning('Failed to read {} of {} databases', len(self.failed), len(self._progress))
+        return self.results
+
+# Refreshes every device in a network
+async def refresh_network(network, port=None, **kwargs):
+    refresh = DBRefresh(network.devices, port, **kwargs)
+    await refresh.run()
+    return refresh
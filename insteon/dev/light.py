@@ -8,10 +8,10 @@ class LightState:
         self._dev = dev
     
     async def set_on(self, onLevel=1, port=None):
-        self._dev.querier.query_std(0x11, max(0, min(255, int(255*onLevel))), port=port)
+        await self._dev.querier.query_std(0x11, max(0, min(255, int(255*onLevel))), port=port)
 
     async def set_off(self, port=None):
-        self._dev.querier.query_std(0x13, 0x00, port=port)
+        await self._dev.querier.query_std(0x13, 0x00, port=port)
 
 class Light(Device):
     def __init__(self, name, address, net=None, modem=None):
@@ -12,6 +12,8 @@ logger = logbook.Logger(__name__)
 from warnings import warn
 
 class LinkRecord:
+    __slots__ = ('offset', 'address', 'group', 'flags', 'data', '_flags_mask')
+
     def __init__(self, offset=None, address=None, group=None, flags=None, data=None,
                         flags_mask=None):
         self.offset = offset
@@ -165,21 +167,136 @@ class LinkRecord:
                     dev, addr, ctrl, flags, group, data_str)
 
 
+# A hash index over the records of a LinkDB. Records whose
+# key can't be determined (i.e a field is None and so matches anything)
+# are kept aside and returned as candidates for every lookup
+class LinkIndex:
+    def __init__(self, key):
+        self._key = key
+        self._buckets = {}
+        self._wild = []
+        # The key each record was filed under (by id), records can be
+        # changed in place after they were added and still be removed
+        self._keys = {}
+
+    def add(self, rec):
+        k = self._key(rec)
+        self._keys[id(rec)] = k
+        if k is None:
+            self._wild.append(rec)
+        else:
+            self._buckets.setdefault(k, []).append(rec)
+
+    def remove(self, rec):
+        if not id(rec) in self._keys:
+            return
+        k = self._keys.pop(id(rec))
+        bucket = self._wild if k is None else self._buckets.get(k, [])
+        for i, r in enumerate(bucket):
+            if r is rec:
+                del bucket[i]
+                break
+        if k is not None and not bucket:
+            self._buckets.pop(k, None)
+
+    def clear(self):
+        self._buckets.clear()
+        self._wild.clear()
+        self._keys.clear()
+
+    def get(self, key):
+        return self._buckets.get(key, [])
+
+    def candidates(self, key):
+        bucket = self._buckets.get(key)
+        if not bucket:
+            return self._wild
+        if not self._wild:
+            return bucket
+        return bucket + self._wild
+
+# The controller bit if it takes part in matching, None otherwise
+def _controller_key(rec, is_filter=False):
+    if rec.flags is None:
+        return None
+    if rec._flags_mask:
+        if is_filter and rec._flags_mask & (1 << 6):
+            return rec.controller
+        return None
+    return rec.controller
+
+def _none_in(*keys):
+    for k in keys:
+        if k is None:
+            return True
+    return False
+
 class LinkDB:
-    def __init__(self, records=None, timestamp=None):
-        self.records = records if records else []
+    def __init__(self, records=None, timestamp=None, delta=None):
+        self.records = []
         self.timestamp = timestamp
+        # The device's database change counter
+        # at the time the records were read (if known)
+        self.delta = delta
+
+        # Insertion order of each record (by id) so that lookups through
+        # the indices come back in the same order as self.records
+        self._order = {}
+        self._next_order = 0
+
+        self._by_offset = LinkIndex(lambda r: r.offset)
+        self._by_address = LinkIndex(lambda r: r.address)
+        self._by_address_group = LinkIndex(
+                lambda r: None if _none_in(r.address, r.group) else (r.address, r.group))
+        self._by_address_group_type = LinkIndex(
+                lambda r: None if _none_in(r.address, r.group, _controller_key(r)) else \
+                                (r.address, r.group, _controller_key(r)))
+        self._indices = [self._by_offset, self._by_address,
+                         self._by_address_group, self._by_address_group_type]
+
+        if records:
+            for r in records:
+                self.add(r)
 
     def __iter__(self):
         for r in self.records:
             yield r
 
     def __contains__(self, record):
-        for r in self.records:
+        for r in self._candidates(record):
             if record.matches(r):
                 return True
         return False
 
+    # The smallest list of records that could possibly match
+    # the given filter record
+    def _candidates(self, filter_rec):
+        f = filter_rec
+        if f.offset is not None:
+            return self._by_offset.candidates(f.offset)
+        if f.address is None:
+            return self.records
+        if f.group is None:
+            return self._by_address.candidates(f.address)
+        ctrl = _controller_key(f, True)
+        if ctrl is None:
+            return self._by_address_group.candidates((f.address, f.group))
+        return self._by_address_group_type.candidates((f.address, f.group, ctrl))
+
+    def _matching(self, filter_rec):
+        matches = [r for r in self._candidates(filter_rec) if filter_rec.matches(r)]
+        if len(matches) > 1:
+            matches.sort(key=lambda r: self._order[id(r)])
+        return matches
+
+    # The indices are built from the record fields when the record is
+    # added, so records which are changed in place must be reindexed
+    def reindex(self):
+        records = self.records
+        self.clear()
+        for r in records:
+            self.add(r)
+
     @property
     def empty(self):
         return not self.records
@@ -216,26 +333,47 @@ class LinkDB:
     # Editing commands
 
     def at(self, offset):
-        for r in self.records:
-            if r.offset == offset:
-                return r
-        return None
+        recs = self._by_offset.get(offset)
+        if not recs:
+            return None
+        if len(recs) > 1:
+            return min(recs, key=lambda r: self._order[id(r)])
+        return recs[0]
 
     def remove(self, rec):
-        self.records.remove(rec)
+        if not id(rec) in self._order:
+            raise ValueError('Record not in database')
+        self._unindex(rec)
+        self.records = [r for r in self.records if r is not rec]
 
     def add(self, rec):
-        if not rec in self.records:
+        if not id(rec) in self._order:
             self.records.append(rec)
+            self._order[id(rec)] = self._next_order
+            self._next_order += 1
+            for i in self._indices:
+                i.add(rec)
+
+    def _unindex(self, rec):
+        del self._order[id(rec)]
+        for i in self._indices:
+            i.remove(rec)
 
     def clear(self):
-        self.records.clear()
+        # don't clear() as reindex() holds onto the old list
+        self.records = []
+        self._order.clear()
+        for i in self._indices:
+            i.clear()
 
     # For removing a particular device
     def remove_matching(self, filter_rec):
-        for r in list(self.records):
-            if filter_rec.matches(r):
-                self.remove(r)
+        matches = self._matching(filter_rec)
+        if not matches:
+            return
+        for r in matches:
+            self._unindex(r)
+        self.records = [r for r in self.records if id(r) in self._order]
 
     def remove_device(self, dev):
         addr = dev.address
@@ -259,17 +397,12 @@ class LinkDB:
         self.add_address(device.address, controller, group, data)
 
     def copy(self):
-        return LinkDB([x.copy() for x in self.records], self.timestamp)
+        return LinkDB([x.copy() for x in self.records], self.timestamp, self.delta)
 
     # For filtering by a record
     # will return a new database
     def filter(self, filter_rec):
-        rec = []
-        for r in self.records:
-            if filter_rec.matches(r):
-                rec.append(r)
-        db = LinkDB(rec, self.timestamp)
-        return db
+        return LinkDB(self._matching(filter_rec), self.timestamp)
 
     # For serialization/unserialization
     @property
@@ -280,6 +413,8 @@ class LinkDB:
         for r in self.records:
             records.append(r.packed)
         packed['records'] = records
+        if self.delta is not None:
+            packed['delta'] = self.delta
         return packed
 
     @staticmethod
@@ -291,7 +426,7 @@ class LinkDB:
         if 'records' in packed:
             for r in packed['records']:
                 records.append(LinkRecord.unpack(r))
-        return LinkDB(records, timestamp)
+        return LinkDB(records, timestamp, packed.get('delta'))
 
     def load(self, filename):
         with open(filename, 'r') as i:
@@ -315,6 +450,7 @@ class LinkDB:
             self.set_timestamp(records.timestamp)
         else:
             self.set_timestamp()
+        self.delta = getattr(records, 'delta', None)
 
     def print(self, formatter=None):
         if not self.valid:
@@ -0,0 +1,195 @@
+import threading
+from contextlib import contextmanager
+
+import logbook
+logger = logbook.Logger(__name__)
+
+_bound_graph = threading.local()
+
+"""
+An index of every link on the network, built from the cached link
+databases of the devices (and the modem).
+
+A link is a (controller, group, responder) triple. It is fully set up
+when the controller has a controller record for the responder on that group
+and the responder has a responder record for the controller on that group.
+If only one of the two exists it is a half link, which will not work.
+
+Each device's records are tracked separately, so when one cache
+changes only that device's contribution is replaced (update()). If a graph
+is bound, the DBManagers keep it up to date as their caches are refreshed.
+"""
+
+CONTROLLER = 'controller'
+RESPONDER = 'responder'
+
+class HalfLink:
+    def __init__(self, controller, group, responder, missing):
+        self.controller = controller
+        self.group = group
+        self.responder = responder
+        self.missing = missing # Which side has no record, CONTROLLER or RESPONDER
+
+    @property
+    def missing_on(self):
+        return self.controller if self.missing == CONTROLLER else self.responder
+
+    def __str__(self):
+        return '{} -> {} group {}: no {} record on {}'.format(
+                    self.controller.human, self.responder.human, self.group,
+                    self.missing, self.missing_on.human)
+
+class LinkGraph:
+    def __init__(self, network=None):
+        # (controller, group, responder) -> set of sides with a record
+        self._links = {}
+        # controller -> group -> set of responders
+        self._responders = {}
+        # responder -> set of (controller, group)
+        self._controllers = {}
+        # owner -> set of (link, side) the owner's db put there
+        self._owned = {}
+
+        if network:
+            self.build(network)
+
+    def build(self, network):
+        self.clear()
+        for dev in network.devices:
+            if hasattr(dev, 'db') and dev.db.cache.valid:
+                self.update(dev.address, dev.db.cache)
+
+    def clear(self):
+        self._links.clear()
+        self._responders.clear()
+        self._controllers.clear()
+        self._owned.clear()
+
+    @property
+    def owners(self):
+        return list(self._owned.keys())
+
+    # The (link, side) entries a database adds
+    def _entries(self, owner, db):
+        entries = set()
+        for r in db:
+            if not r.active or r.address is None or r.address == owner:
+                continue
+            if r.controller:
+                entries.add(((owner, r.group, r.address), CONTROLLER))
+            else:
+                entries.add(((r.address, r.group, owner), RESPONDER))
+        return entries
+
+    def _add(self, link, side):
+        sides = self._links.get(link)
+        if sides is None:
+            sides = set()
+            self._links[link] = sides
+            ctrl, group, resp = link
+            self._responders.setdefault(ctrl, {}).setdefault(group, set()).add(resp)
+            self._controllers.setdefault(resp, set()).add((ctrl, group))
+        sides.add(side)
+
+    def _discard(self, link, side):
+        sides = self._links.get(link)
+        if sides is None:
+            return
+        sides.discard(side)
+        if sides:
+            return
+        del self._links[link]
+        ctrl, group, resp = link
+        groups = self._responders[ctrl]
+        groups[group].discard(resp)
+        if not groups[group]:
+            del groups[group]
+            if not groups:
+                del self._responders[ctrl]
+        self._controllers[resp].discard((ctrl, group))
+        if not self._controllers[resp]:
+            del self._controllers[resp]
+
+    # Replaces everything known about the
+    # links in the database of the owner device
+    def update(self, owner, db):
+        new = self._entries(owner, db)
+        old = self._owned.get(owner, set())
+        for link, side in old - new:
+            self._discard(link, side)
+        for link, side in new - old:
+            self._add(link, side)
+        self._owned[owner] = new
+
+    def remove(self, owner):
+        for link, side in self._owned.pop(owner, set()):
+            self._discard(link, side)
+
+    # Addresses of the devices which respond to a controller
+    # (on a particular group, or any group if None)
+    def responders(self, controller, group=None):
+        groups = self._responders.get(controller)
+        if not groups:
+            return set()
+        if group is not None:
+            return set(groups.get(group, ()))
+        return set().union(*groups.values())
+
+    # (controller address, group) of everything a device responds to
+    def controllers(self, responder):
+        return set(self._controllers.get(responder, ()))
+
+    # Groups a device controls something on
+    def groups(self, controller):
+        return set(self._responders.get(controller, {}).keys())
+
+    # Whether there is a record for the link on the controller,
+    # the responder or both (the set of sides)
+    def link(self, controller, group, responder):
+        return set(self._links.get((controller, group, responder), ()))
+
+    # Links with a record on only one side. Unless include_unknown is set
+    # only links between two devices whose databases are known are reported
+    # (a missing record on a device whose db hasn't been read isn't news)
+    def half_links(self, include_unknown=False):
+        halves = []
+        for (ctrl, group, resp), sides in self._links.items():
+            if len(sides) == 2:
+                continue
+            missing = RESPONDER if CONTROLLER in sides else CONTROLLER
+            missing_on = resp if missing == RESPONDER else ctrl
+            if include_unknown or missing_on in self._owned:
+                halves.append(HalfLink(ctrl, group, resp, missing))
+        return halves
+
+    def print(self):
+        for ctrl, groups in self._responders.items():
+            for group, resps in sorted(groups.items()):
+                print('{} group {}: {}'.format(ctrl.human, group,
+                            ', '.join(r.human for r in resps)))
+
+    def bind(self):
+        stack = getattr(_bound_graph, 'stack', None)
+        if not stack:
+            stack = []
+            _bound_graph.stack = stack
+        stack.append(self)
+
+    def unbind(self):
+        stack = getattr(_bound_graph, 'stack', None)
+        if stack:
+            stack.remove(self)
+
+    @contextmanager
+    def use(self):
+        self.bind()
+        yield
+        self.unbind()
+
+    @staticmethod
+    def bound():
+        stack = getattr(_bound_graph, 'stack', None)
+        if stack:
+            return stack[-1]
+        else:
+            return None
@@ -0,0 +1,227 @@
+from .linkdb import LinkDB, LinkRecord
+from ..util import InsteonError
+
+import logbook
+logger = logbook.Logger(__name__)
+
+"""
+Works out the edits needed to turn one link database into another
+without touching the device, so that the plan can be previewed (dry run),
+costed and then applied as is.
+
+plan_device() follows the same steps as the generic device write used to:
+    1. if the modem's own link is going away, temporarily link the modem
+       in the first free slot so we keep access to the database
+    2. write the new records into free slots (deleted, inactive or past the end)
+    3. deactivate the records that are no longer wanted
+    4. move the end marker up to just after the last active record
+    5. remove the temporary modem link
+"""
+
+# Powerline timing, in seconds per hop, for a standard (5 packets + gap)
+# and extended (11 packets + 2 gaps) message at 60Hz zero crossings
+STD_MSG_TIME = 6 / 120
+EXT_MSG_TIME = 13 / 120
+
+class PlanStep:
+    WRITE = 'write' # write a record at an offset
+    DEACTIVATE = 'deactivate' # rewrite a record at an offset with the active bit cleared
+    END = 'end' # write the null end marker at an offset
+    MODEM_LINK = 'modem link' # write the temporary modem link at an offset
+    MODEM_UNLINK = 'modem unlink' # deactivate or null the temporary modem link
+    ADD = 'add' # (modem) add a record
+    DELETE = 'delete' # (modem) delete a record
+
+    def __init__(self, action, offset=None, record=None):
+        self.action = action
+        self.offset = offset
+        self.record = record
+
+    # Whether this step is written as a device
+    # extended message (as opposed to a modem command)
+    @property
+    def remote(self):
+        return self.offset is not None
+
+    def __str__(self):
+        offset = '{:04x}'.format(self.offset) if self.offset is not None else '    '
+        record = str(self.record) if self.record else ''
+        return '{} {:12s} {}'.format(offset, self.action, record)
+
+class LinkPlan:
+    def __init__(self, steps=None):
+        self.steps = steps if steps else []
+
+    def __iter__(self):
+        for s in self.steps:
+            yield s
+
+    def __len__(self):
+        return len(self.steps)
+
+    @property
+    def empty(self):
+        return not self.steps
+
+    def _of(self, action):
+        return [s for s in self.steps if s.action == action]
+
+    @property
+    def writes(self):
+        return {s.offset: s.record for s in self._of(PlanStep.WRITE)}
+
+    @property
+    def deactivations(self):
+        return {s.offset: s.record for s in self._of(PlanStep.DEACTIVATE)}
+
+    @property
+    def end_offset(self):
+        ends = self._of(PlanStep.END)
+        return ends[-1].offset if ends else None
+
+    @property
+    def modem_offset(self):
+        links = self._of(PlanStep.MODEM_LINK)
+        return links[0].offset if links else None
+
+    # Number of messages sent to carry out the plan. Every device
+    # step is an extended message which the device ACKs
+    @property
+    def message_count(self):
+        return sum(2 if s.remote else 1 for s in self.steps)
+
+    # Estimated powerline time (in seconds) taken by the plan
+    # if every message uses up all of its hops
+    def airtime(self, hops=3):
+        per_step = (hops + 1) * (EXT_MSG_TIME + STD_MSG_TIME)
+        return sum(per_step for s in self.steps if s.remote)
+
+    def print(self):
+        for s in self.steps:
+            print(s)
+        print('{} messages, ~{:.1f}s airtime'.format(self.message_count, self.airtime()))
+
+# Records are the same link (ignoring offset)
+# if all of these are the same
+def _link_key(rec):
+    return (rec.address, rec.group, rec.flags,
+            tuple(rec.data) if rec.data is not None else None)
+
+def _without_offset(rec):
+    r = rec.copy()
+    r.offset = None
+    return r
+
+def plan_device(currentdb, targetdb, modem_addr):
+    # Dups: all but the lowest offset copy of a link
+    first = {}
+    for r in sorted((r for r in currentdb if r.active), key=lambda r: r.offset):
+        first.setdefault(_link_key(r), r)
+
+    delete_records = []
+    for record in currentdb:
+        if not record.active:
+            continue
+        if first[_link_key(record)] is not record:
+            logger.debug('Found dup  record: {}'.format(record))
+            delete_records.append(record)
+        elif not _without_offset(record) in targetdb:
+            logger.debug('Found del  record: {}'.format(record))
+            delete_records.append(record)
+
+    free = list(delete_records)
+    for record in currentdb:
+        if not record.active:
+            free.append(record)
+            if record.null:
+                # The slots past the end are free too
+                for i in range(targetdb.size):
+                    if record.offset - (i + 1) * 0x08 > 0x08:
+                        free.append(LinkRecord(offset=record.offset - (i + 1)*0x08))
+    # Don't hand out the same slot twice
+    seen = set()
+    free_offsets = []
+    for r in free:
+        if not r.offset in seen:
+            seen.add(r.offset)
+            free_offsets.append(r.offset)
+    free_offsets.reverse() # pop() from the front
+
+    def take_slot():
+        if not free_offsets:
+            raise InsteonError('Out of database space!')
+        return free_offsets.pop()
+
+    # Predicted contents of the device after each step, by offset
+    predicted = {r.offset: r for r in currentdb if r.offset is not None}
+    steps = []
+
+    # if the modem is being removed, add the modem at the first free offset temporarily
+    modem_record = LinkRecord(address=modem_addr)
+    modem_record.mask_link_type()
+    modem_record.mask_active()
+    modem_record.active = True
+    modem_record.controller = False
+    modem_record.high_water = False
+
+    modem_offset = None
+    if LinkDB(delete_records).filter(modem_record).records:
+        modem_offset = take_slot()
+        rec = modem_record.copy()
+        rec.offset = modem_offset
+        steps.append(PlanStep(PlanStep.MODEM_LINK, modem_offset, rec))
+        predicted[modem_offset] = rec
+
+    # Write any new entries into the free spaces
+    for record in targetdb:
+        if not record.active:
+            continue
+        if not _without_offset(record) in currentdb:
+            offset = take_slot()
+            rec = record.copy()
+            rec.offset = offset
+            steps.append(PlanStep(PlanStep.WRITE, offset, rec))
+            predicted[offset] = rec
+
+    # Disable anything that shouldn't be in the database
+    # (unless it has been written over already)
+    deactivations = []
+    for record in delete_records:
+        if predicted.get(record.offset) is not record:
+            continue
+        rec = record.copy()
+        rec.active = False
+        deactivations.append(PlanStep(PlanStep.DEACTIVATE, rec.offset, rec))
+        predicted[rec.offset] = rec
+
+    # Chop off after the end, anything at or past
+    # the end doesn't need deactivating
+    end_offset = currentdb.start_offset
+    for offset, r in predicted.items():
+        if r.active and offset - 0x08 < end_offset:
+            end_offset = offset - 0x08
+    steps.extend(s for s in deactivations if s.offset > end_offset)
+    steps.append(PlanStep(PlanStep.END, end_offset))
+
+    if modem_offset is not None:
+        # If the modem is the last record, just move the end up
+        if modem_offset == end_offset + 0x08:
+            steps.append(PlanStep(PlanStep.MODEM_UNLINK, modem_offset))
+        else:
+            rec = predicted[modem_offset].copy()
+            rec.active = False
+            steps.append(PlanStep(PlanStep.MODEM_UNLINK, modem_offset, rec))
+
+    return LinkPlan(steps)
+
+def plan_modem(currentdb, targetdb):
+    steps = []
+    # If we do not find this record (regardless of offset) in the
+    # target database, delete it!
+    for record in currentdb:
+        if not _without_offset(record) in targetdb:
+            steps.append(PlanStep(PlanStep.DELETE, None, record))
+    for record in targetdb:
+        if not _without_offset(record) in currentdb:
+            steps.append(PlanStep(PlanStep.ADD, None, record))
+    return LinkPlan(steps)
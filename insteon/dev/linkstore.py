@@ -0,0 +1,227 @@
+import sqlite3
+import datetime
+import threading
+from contextlib import contextmanager
+
+from .linkdb import LinkDB, LinkRecord
+from ..io.address import Address
+
+import logbook
+logger = logbook.Logger(__name__)
+
+_bound_store = threading.local()
+
+"""
+A single sqlite file holding the link databases of every device
+(and the modem) on the network, along with their history.
+
+Every save() of a database which differs from the last one saved for
+that device adds a new snapshot, the latest snapshot of each device is
+its current database. Records are stored one per row and indexed by
+link address so questions like "who links to this device" don't need
+every database loaded.
+"""
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner INTEGER NOT NULL,
+    timestamp REAL,
+    delta INTEGER,
+    kind TEXT NOT NULL DEFAULT 'cache'
+);
+CREATE INDEX IF NOT EXISTS snapshots_owner ON snapshots (owner, id);
+CREATE TABLE IF NOT EXISTS records (
+    snapshot INTEGER NOT NULL REFERENCES snapshots(id) ON DELETE CASCADE,
+    offset INTEGER,
+    address INTEGER,
+    grp INTEGER,
+    flags INTEGER,
+    data BLOB
+);
+CREATE INDEX IF NOT EXISTS records_snapshot ON records (snapshot);
+CREATE INDEX IF NOT EXISTS records_address ON records (address, grp);
+CREATE TABLE IF NOT EXISTS current (
+    owner INTEGER PRIMARY KEY,
+    snapshot INTEGER NOT NULL REFERENCES snapshots(id)
+);
+'''
+
+def _pack_address(addr):
+    if addr is None:
+        return None
+    hi, mid, low = addr.array
+    return (hi << 16) | (mid << 8) | low
+
+def _unpack_address(val):
+    if val is None:
+        return None
+    return Address((val >> 16) & 0xFF, (val >> 8) & 0xFF, val & 0xFF)
+
+def _pack_time(ts):
+    return ts.timestamp() if ts else None
+
+def _unpack_time(val):
+    return datetime.datetime.fromtimestamp(val) if val is not None else None
+
+def _record_row(r):
+    return (r.offset, _pack_address(r.address), r.group, r.flags,
+            bytes(r.data) if r.data is not None else None)
+
+def _row_record(row):
+    offset, address, group, flags, data = row
+    return LinkRecord(offset, _unpack_address(address), group, flags,
+                      list(data) if data is not None else None)
+
+class LinkStore:
+    def __init__(self, path):
+        self._path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA foreign_keys = ON')
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    # Stores db as the current database of the device at the owner
+    # address, returns the snapshot id. If nothing but the timestamp and delta
+    # changed since the last save, the last snapshot is updated instead
+    def save(self, owner, db, kind='cache'):
+        owner_key = _pack_address(owner)
+        rows = [_record_row(r) for r in db]
+        with self._conn:
+            latest = self._current_id(owner_key)
+            if latest is not None and kind == 'cache' and \
+                    self._snapshot_rows(latest) == rows:
+                self._conn.execute('UPDATE snapshots SET timestamp = ?, delta = ? WHERE id = ?',
+                                   (_pack_time(db.timestamp), db.delta, latest))
+                return latest
+
+            cur = self._conn.execute(
+                    'INSERT INTO snapshots (owner, timestamp, delta, kind) VALUES (?, ?, ?, ?)',
+                    (owner_key, _pack_time(db.timestamp), db.delta, kind))
+            snapshot = cur.lastrowid
+            self._conn.executemany(
+                    'INSERT INTO records (snapshot, offset, address, grp, flags, data) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(snapshot,) + r for r in rows])
+            if kind == 'cache':
+                self._conn.execute('INSERT OR REPLACE INTO current (owner, snapshot) VALUES (?, ?)',
+                                   (owner_key, snapshot))
+            return snapshot
+
+    # Loads the current database of a device (or a particular snapshot)
+    # into db (a new LinkDB if None). Returns None if nothing is stored
+    def load(self, owner, db=None, snapshot=None):
+        if snapshot is None:
+            snapshot = self._current_id(_pack_address(owner))
+            if snapshot is None:
+                return None
+        row = self._conn.execute('SELECT timestamp, delta FROM snapshots WHERE id = ?',
+                                 (snapshot,)).fetchone()
+        if not row:
+            return None
+        loaded = LinkDB([_row_record(r) for r in self._snapshot_rows(snapshot)],
+                        _unpack_time(row[0]), row[1])
+        if db is None:
+            return loaded
+        db.update(loaded)
+        return db
+
+    # All the current databases in one go, as a dict of owner address -> LinkDB
+    def load_all(self):
+        dbs = {}
+        for owner, ts, delta in self._conn.execute(
+                'SELECT c.owner, s.timestamp, s.delta FROM current c '
+                'JOIN snapshots s ON s.id = c.snapshot'):
+            dbs[owner] = LinkDB(None, _unpack_time(ts), delta)
+
+        for row in self._conn.execute(
+                'SELECT c.owner, r.offset, r.address, r.grp, r.flags, r.data FROM current c '
+                'JOIN records r ON r.snapshot = c.snapshot ORDER BY r.rowid'):
+            dbs[row[0]].add(_row_record(row[1:]))
+
+        return {_unpack_address(o): db for o, db in dbs.items()}
+
+    # Fills in the db cache of every device in the network
+    # that has a stored database
+    def restore(self, network):
+        restored = 0
+        for owner, db in self.load_all().items():
+            dev = network.get_by_address(owner)
+            if dev and hasattr(dev, 'db'):
+                dev.db.cache.update(db)
+                restored = restored + 1
+        logger.debug('Restored {} link databases', restored)
+        return restored
+
+    # (id, timestamp, delta, kind) of every snapshot of a device, oldest first
+    def history(self, owner):
+        return [(i, _unpack_time(ts), delta, kind) for i, ts, delta, kind in self._conn.execute(
+                    'SELECT id, timestamp, delta, kind FROM snapshots WHERE owner = ? ORDER BY id',
+                    (_pack_address(owner),))]
+
+    # Searches the current databases without loading them,
+    # returns a list of (owner address, LinkRecord)
+    def find(self, address=None, group=None, controller=None):
+        query = 'SELECT c.owner, r.offset, r.address, r.grp, r.flags, r.data FROM records r ' \
+                'JOIN current c ON c.snapshot = r.snapshot WHERE 1'
+        args = []
+        if address is not None:
+            query += ' AND r.address = ?'
+            args.append(_pack_address(address))
+        if group is not None:
+            query += ' AND r.grp = ?'
+            args.append(group)
+        if controller is not None:
+            query += ' AND (r.flags & 64) = ?'
+            args.append(64 if controller else 0)
+        query += ' ORDER BY r.rowid'
+        return [(_unpack_address(row[0]), _row_record(row[1:]))
+                    for row in self._conn.execute(query, args)]
+
+    # Drops all but the last keep snapshots of every device
+    # (the current ones are always kept)
+    def prune(self, keep=10):
+        with self._conn:
+            self._conn.execute(
+                'DELETE FROM snapshots WHERE id NOT IN (SELECT snapshot FROM current) AND id NOT IN '
+                '(SELECT id FROM snapshots s WHERE '
+                ' (SELECT COUNT(*) FROM snapshots t WHERE t.owner = s.owner AND t.id > s.id) < ?)',
+                (keep,))
+
+    def _current_id(self, owner_key):
+        row = self._conn.execute('SELECT snapshot FROM current WHERE owner = ?',
+                                 (owner_key,)).fetchone()
+        return row[0] if row else None
+
+    def _snapshot_rows(self, snapshot):
+        return [tuple(r) for r in self._conn.execute(
+                'SELECT offset, address, grp, flags, data FROM records WHERE snapshot = ? ORDER BY rowid',
+                (snapshot,))]
+
+    def bind(self):
+        stack = getattr(_bound_store, 'stack', None)
+        if not stack:
+            stack = []
+            _bound_store.stack = stack
+        stack.append(self)
+
+    def unbind(self):
+        stack = getattr(_bound_store, 'stack', None)
+        if stack:
+            stack.remove(self)
+
+    @contextmanager
+    def use(self):
+        self.bind()
+        yield
+        self.unbind()
+
+    @staticmethod
+    def bound():
+        stack = getattr(_bound_store, 'stack', None)
+        if stack:
+            return stack[-1]
+        else:
+            return None
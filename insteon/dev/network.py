@@ -19,6 +19,10 @@ class Network:
         else:
             return None
 
+    @property
+    def devices(self):
+        return list(self._dev_by_addr.values())
+
     def print(self):
         for name, dev in self._dev_by_name.items():
             print('{} {}'.format(dev.address.human, name))
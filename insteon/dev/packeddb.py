@@ -0,0 +1,297 @@
+import datetime
+
+from .linkdb import LinkDB, LinkRecord
+from ..io.address import Address
+
+"""
+A device link database kept in the same layout as the device memory:
+8 bytes per record (flags, group, address hi/mid/low, data 1-3) with
+the first record at the start offset (0x0fff) and each following record
+8 bytes below it.
+
+Records are handed out as LinkRecordViews, small objects which read and
+write straight through to the buffer, so a database costs 8 bytes a
+record plus whatever views are being held onto. Only device databases
+can be packed, every record needs an offset.
+"""
+
+RECORD_SIZE = 8
+
+class LinkRecordView:
+    __slots__ = ('_db', '_slot')
+
+    def __init__(self, db, slot):
+        self._db = db
+        self._slot = slot
+
+    def _byte(self, i):
+        return self._db._buf[self._slot*RECORD_SIZE + i]
+
+    def _set_byte(self, i, val):
+        self._db._buf[self._slot*RECORD_SIZE + i] = val & 0xFF
+
+    @property
+    def offset(self):
+        return self._db._start - self._slot*RECORD_SIZE
+
+    @property
+    def address(self):
+        o = self._slot*RECORD_SIZE
+        b = self._db._buf
+        return Address(b[o + 2], b[o + 3], b[o + 4])
+
+    @address.setter
+    def address(self, addr):
+        o = self._slot*RECORD_SIZE
+        self._db._buf[o + 2:o + 5] = addr.bytes
+
+    @property
+    def group(self):
+        return self._byte(1)
+
+    @group.setter
+    def group(self, val):
+        self._set_byte(1, val)
+
+    @property
+    def flags(self):
+        return self._byte(0)
+
+    @flags.setter
+    def flags(self, val):
+        self._set_byte(0, val)
+
+    @property
+    def data(self):
+        o = self._slot*RECORD_SIZE
+        return list(self._db._buf[o + 5:o + 8])
+
+    @data.setter
+    def data(self, val):
+        o = self._slot*RECORD_SIZE
+        self._db._buf[o + 5:o + 8] = bytes(val)
+
+    # Views are never filters
+    @property
+    def _flags_mask(self):
+        return None
+
+    @property
+    def raw(self):
+        o = self._slot*RECORD_SIZE
+        return memoryview(self._db._buf)[o:o + RECORD_SIZE]
+
+    @property
+    def bytes(self):
+        return list(self.raw)
+
+    @property
+    def null(self):
+        return not any(self.raw)
+
+    @property
+    def active(self):
+        return self.flags & (1 << 7) > 0
+
+    @active.setter
+    def active(self, value):
+        self.flags = (self.flags & ~(1 << 7)) | ((1 << 7) if value else 0)
+
+    @property
+    def high_water(self):
+        return self.flags & (1 << 1) == 0
+
+    @high_water.setter
+    def high_water(self, value):
+        self.flags = (self.flags & ~(1 << 1)) | (0 if value else (1 << 1))
+
+    @property
+    def controller(self):
+        return self.flags & (1 << 6) > 0
+
+    @controller.setter
+    def controller(self, value):
+        self.flags = (self.flags & ~(1 << 6)) | ((1 << 6) if value else 0)
+
+    @property
+    def responder(self):
+        return not self.controller
+
+    @responder.setter
+    def responder(self, value):
+        self.controller = not value
+
+    def matches(self, other):
+        return self.copy().matches(other)
+
+    # A standalone LinkRecord with the same contents
+    def copy(self):
+        return LinkRecord(self.offset, self.address, self.group,
+                          self.flags, self.data)
+
+    def __str__(self):
+        return str(self.copy())
+
+class PackedLinkDB:
+    # buf is used as is (not copied) if it is a bytearray
+    def __init__(self, buf=None, start=0x0fff, timestamp=None, delta=None):
+        if buf is None:
+            buf = bytearray()
+        elif not isinstance(buf, bytearray):
+            buf = bytearray(buf)
+        if len(buf) % RECORD_SIZE:
+            raise ValueError('Buffer length must be a multiple of {}'.format(RECORD_SIZE))
+        self._buf = buf
+        self._start = start
+        self.timestamp = timestamp
+        self.delta = delta
+
+    # Wraps a dump of raw records (as read with 0x2f)
+    @staticmethod
+    def frombuffer(buf, start=0x0fff, timestamp=None, delta=None):
+        return PackedLinkDB(buf, start, timestamp, delta)
+
+    @staticmethod
+    def from_linkdb(db, start=0x0fff):
+        packed = PackedLinkDB(None, start, db.timestamp, getattr(db, 'delta', None))
+        for r in db:
+            packed.add(r)
+        return packed
+
+    def to_linkdb(self):
+        return LinkDB([r.copy() for r in self], self.timestamp, self.delta)
+
+    # The records, in device layout
+    @property
+    def raw(self):
+        return memoryview(self._buf)
+
+    def __iter__(self):
+        for slot in range(self.size):
+            yield LinkRecordView(self, slot)
+
+    def __contains__(self, record):
+        for r in self._candidates(record):
+            if record.matches(r):
+                return True
+        return False
+
+    def __eq__(self, other):
+        return isinstance(other, PackedLinkDB) and \
+                self._start == other._start and self._buf == other._buf
+
+    @property
+    def records(self):
+        return list(self)
+
+    @property
+    def empty(self):
+        return not self._buf
+
+    @property
+    def valid(self):
+        return self.timestamp is not None
+
+    @property
+    def size(self):
+        return len(self._buf) // RECORD_SIZE
+
+    @property
+    def start_offset(self):
+        return self._start
+
+    @property
+    def end_offset(self):
+        last_off = self._start
+        for slot in range(self.size):
+            if self._buf[slot*RECORD_SIZE] & (1 << 7):
+                last_off = self._start - (slot + 1)*RECORD_SIZE
+        return last_off
+
+    def _slot(self, offset):
+        diff = self._start - offset
+        if diff < 0 or diff % RECORD_SIZE:
+            return None
+        return diff // RECORD_SIZE
+
+    # Only looks at records with the filter's address if it has one,
+    # comparing bytes rather than building views for every record
+    def _candidates(self, filter_rec):
+        if filter_rec.offset is not None:
+            slot = self._slot(filter_rec.offset)
+            if slot is None or slot >= self.size:
+                return []
+            return [LinkRecordView(self, slot)]
+        if filter_rec.address is None:
+            return list(self)
+        addr = filter_rec.address.bytes
+        buf = self._buf
+        return [LinkRecordView(self, slot) for slot in range(self.size)
+                    if buf[slot*RECORD_SIZE + 2:slot*RECORD_SIZE + 5] == addr]
+
+    # Offsets of the records which differ between
+    # this and another packed database
+    def diff(self, other):
+        a, b = self.raw, other.raw
+        offsets = []
+        for slot in range(max(self.size, other.size)):
+            o = slot*RECORD_SIZE
+            if a[o:o + RECORD_SIZE] != b[o:o + RECORD_SIZE]:
+                offsets.append(self._start - o)
+        return offsets
+
+    def set_timestamp(self, ts=None):
+        self.timestamp = ts if ts else datetime.datetime.now()
+
+    def set_invalid(self):
+        self.timestamp = None
+
+    def at(self, offset):
+        slot = self._slot(offset)
+        if slot is None or slot >= self.size:
+            return None
+        return LinkRecordView(self, slot)
+
+    # Writes the record into its slot, growing the database if needed
+    def add(self, rec):
+        if rec.offset is None:
+            raise ValueError('Packed databases need record offsets')
+        slot = self._slot(rec.offset)
+        if slot is None:
+            raise ValueError('Offset {:04x} not in database'.format(rec.offset))
+        if slot >= self.size:
+            self._buf.extend(bytes((slot + 1 - self.size) * RECORD_SIZE))
+        o = slot*RECORD_SIZE
+        self._buf[o:o + RECORD_SIZE] = bytes(rec.bytes)
+
+    # Nulls out the record's slot
+    def remove(self, rec):
+        slot = self._slot(rec.offset)
+        if slot is None or slot >= self.size:
+            raise ValueError('Record not in database')
+        o = slot*RECORD_SIZE
+        self._buf[o:o + RECORD_SIZE] = bytes(RECORD_SIZE)
+
+    def remove_matching(self, filter_rec):
+        for r in [r for r in self._candidates(filter_rec) if filter_rec.matches(r)]:
+            self.remove(r)
+
+    def clear(self):
+        self._buf = bytearray()
+
+    def copy(self):
+        return PackedLinkDB(bytearray(self._buf), self._start, self.timestamp, self.delta)
+
+    def filter(self, filter_rec):
+        return LinkDB([r.copy() for r in self._candidates(filter_rec) if filter_rec.matches(r)],
+                      self.timestamp, self.delta)
+
+    def update(self, records):
+        self.clear()
+        for r in records:
+            self.add(r)
+        if hasattr(records, 'timestamp'):
+            self.set_timestamp(records.timestamp)
+        else:
+            self.set_timestamp()
+        self.delta = getattr(records, 'delta', None)
@@ -0,0 +1,177 @@
+import asyncio
+import time
+
+from .linkplan import STD_MSG_TIME
+from .statecache import StateCache, QUERIED
+from ..io.message import MsgType
+from ..io.admission import RequestRejected
+
+import logbook
+logger = logbook.Logger(__name__)
+
+"""
+Polls device status in the background to catch changes nobody told us
+about (e.g. someone pressing a switch that isn't linked to the modem),
+without crowding out everything else on the powerline.
+
+    - the device whose state is most overdue is polled first. A device is
+      due every interval seconds, sooner the more often its level has been
+      seen to change (its volatility, in changes per hour)
+    - polls only use up to budget (a fraction) of the powerline time,
+      after each poll the poller sits idle long enough to stay under it
+    - devices that don't answer are backed off exponentially
+    - nothing is polled while other requests are waiting on the port, and
+      polls are queued at a low priority so real commands go first
+"""
+
+class PollStats:
+    def __init__(self):
+        self.polls = 0
+        self.failures = 0 # Failures in a row
+        self.retry_at = 0
+
+class Poller:
+    def __init__(self, devices, cache=None, port=None, interval=600, budget=0.1,
+                        hops=3, retry_delay=30, max_backoff=3600, priority=10):
+        self._devices = {d.address: d for d in devices if hasattr(d, 'querier')}
+        self.cache = cache if cache else (StateCache.bound() or StateCache())
+        if port is None and self._devices:
+            port = next(iter(self._devices.values())).port
+        self.port = port
+
+        if not 0 < budget <= 1:
+            raise ValueError('The polling budget has to be a fraction above 0 and at most 1')
+        self.interval = interval
+        self.budget = budget
+        self.hops = hops
+        self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+        self.priority = priority
+
+        self._stats = {a: PollStats() for a in self._devices}
+        self._running = False
+        self._wakeup = None
+
+    def add(self, device):
+        self._devices[device.address] = device
+        self._stats.setdefault(device.address, PollStats())
+
+    def remove(self, device):
+        self._devices.pop(device.address, None)
+        self._stats.pop(device.address, None)
+
+    def stats(self, address):
+        return self._stats.get(address)
+
+    # Airtime of a status request and its ACK using up all of the hops
+    @property
+    def poll_cost(self):
+        return 2 * (self.hops + 1) * STD_MSG_TIME
+
+    # How often a device should be polled
+    def due_interval(self, address):
+        state = self.cache.get(address)
+        volatility = state.volatility if state else 0
+        return self.interval / (1 + volatility)
+
+    # How overdue a device is (1 meaning just due), None if it is backed off
+    def overdue(self, address, now=None):
+        now = now if now is not None else time.time()
+        if self._stats[address].retry_at > now:
+            return None
+        state = self.cache.get(address)
+        if not state or state.age is None:
+            return float('inf')
+        ratio = state.age / self.due_interval(address)
+        if state.confidence < QUERIED:
+            # Not quite as good as having asked, a little more overdue
+            ratio = ratio * 1.25
+        return ratio
+
+    # The device to poll next (None if nothing is due) and
+    # how long until something might be
+    def next(self):
+        now = time.time()
+        best, best_ratio = None, 0
+        wait = self.interval
+        for addr in self._devices:
+            ratio = self.overdue(addr, now)
+            if ratio is None:
+                wait = min(wait, self._stats[addr].retry_at - now)
+                continue
+            if ratio >= 1 and ratio > best_ratio:
+                best, best_ratio = addr, ratio
+            elif ratio < 1:
+                wait = min(wait, (1 - ratio) * self.due_interval(addr))
+        return (self._devices[best] if best else None), max(wait, 0)
+
+    # Queries the status of a device, returns whether it answered
+    async def poll(self, device):
+        stats = self._stats[device.address]
+        stats.polls += 1
+
+        msg = device.querier.create_std(0x19, 0x00, port=self.port)
+        ack = None
+        try:
+            with self.port.write(msg, priority=self.priority) as req:
+                if await req.wait_success_fail(timeout=2):
+                    ack = await req.wait_until(lambda m: m.type == 'StandardMessageReceived' and \
+                                                    m['fromAddress'] == device.address and \
+                                                    MsgType.from_msg(m) == MsgType.ACK_OF_DIRECT, timeout=4)
+                elif isinstance(req.error, RequestRejected):
+                    raise req.error
+        except RequestRejected as e:
+            # Turned away (or shed) by the port, which says nothing
+            # about the device, so try again later without backing off
+            stats.retry_at = time.time() + self.retry_delay
+            logger.debug('Poll of {} rejected ({}), retrying in {}s', device.address, e, self.retry_delay)
+            return False
+
+        if not ack:
+            stats.failures += 1
+            backoff = min(self.retry_delay * 2**(stats.failures - 1), self.max_backoff)
+            stats.retry_at = time.time() + backoff
+            logger.debug('No status from {}, backing off {}s', device.address, backoff)
+            return False
+
+        stats.failures = 0
+        stats.retry_at = 0
+        # An attached cache picked up the ACK itself
+        if not self.cache.attached(self.port):
+            self.cache.set(device.address, ack['command2'], QUERIED, 'status')
+        return True
+
+    # Other requests are waiting to go out
+    @property
+    def busy(self):
+        return self.port.queued > 0
+
+    async def _sleep(self, delay):
+        self._wakeup = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup = None
+
+    async def run(self, check_interval=0.5):
+        self._running = True
+        while self._running:
+            if self.busy:
+                await self._sleep(check_interval)
+                continue
+
+            device, wait = self.next()
+            if not device:
+                await self._sleep(max(wait, check_interval))
+                continue
+
+            await self.poll(device)
+            # Stay under budget
+            cost = self.poll_cost
+            await self._sleep(cost / self.budget - cost)
+
+    def stop(self):
+        self._running = False
+        if self._wakeup:
+            self._wakeup.set()
@@ -1,12 +1,14 @@
-from ..util import InsteonError, calc_simple_crc, calc_long_crc
+import asyncio
+
+from ..util import InsteonError
 from ..io.message import MsgType
+from ..io.extbuilder import ExtMsgBuilder
 
 class Querier:
     def __init__(self, dev):
         self._dev = dev
 
-    def send_std(self, cmd1, cmd2, flag=MsgType.DIRECT,
-                        wait_response=False, extra_channels=[], port=None):
+    def create_std(self, cmd1, cmd2, flag=MsgType.DIRECT, port=None):
         port = port if port else self._dev.port
 
         msg = port.defs['SendStandardMessage'].create()
@@ -14,77 +16,116 @@ class Querier:
         msg['messageFlags'] = flag.value | 0xf
         msg['command1'] = cmd1
         msg['command2'] = cmd2
+        return msg
 
-        direct_ack_channel = Channel(lambda x: x.type == 'StandardMessageReceived' and
-                                            (MsgType.from_value(x['messageFlags']) == MsgType.ACK_OF_DIRECT or
-                                             MsgType.from_value(x['messageFlags']) == MsgType.NACK_OF_DIRECT) and
-                                            x['fromAddress'] == self._dev.address)
-        ack_reply = Channel()
-
-        extras = [direct_ack_channel]
-        extras.extend(extra_channels)
-
-        port.write(msg, ack_reply_channel=ack_reply, custom_channels=extras)
-
-        if not ack_reply.wait(3):
-            raise InsteonError('No IM reply to send command!')
-
-        if wait_response:
-            if not direct_ack_channel.wait(4):
-                raise InsteonError('No response to standard query received')
-
-        return direct_ack_channel
-
-    def query_std(self, cmd1, cmd2, flag=MsgType.DIRECT,
-                    wait_response=True, extra_channels=[], port=None):
-        return self.send_std(cmd1, cmd2, flag, wait_response, extra_channels, port)
-
-    def send_ext(self, cmd1, cmd2, data, flag=MsgType.DIRECT, large_checksum=False,
-                    wait_response=False, extra_channels=[], port=None):
+    def create_ext(self, cmd1, cmd2, data, flag=MsgType.DIRECT, large_checksum=False, port=None):
         port = port if port else self._dev.port
+        return ExtMsgBuilder.get(port.defs).build(self._dev.address, cmd1, cmd2, data,
+                                                  flag, large_checksum)
 
-        msg = port.defs['SendExtendedMessage'].create()
-        msg['toAddress'] = self._dev.address
-        msg['messageFlags'] = flag.value | (1 << 4) | 0xf
-        msg['command1'] = cmd1
-        msg['command2'] = cmd2
-
-        if large_checksum and len(data) > 12 or len(data) > 13:
-            raise InsteonError('Cannot send more than 12 or 13 bytes in an ext message')
-
-        for i,x in enumerate(data):
-            msg['userData{}'.format(i + 1)] = x
-
-        checksum_data = [cmd1, cmd2]
-        checksum_data.extend(data)
-
-        if large_checksum:
-            crc = calc_long_crc(checksum_data)
-            msg['userData13'] = crc & 0xFF
-            msg['userData14'] = (crc >> 8) & 0xFF
-        else:
-            msg['userData14'] = calc_simple_crc(checksum_data)
-
-        direct_ack_channel = Channel(lambda x: (x.type == 'ExtendedMessageReceived' or 
-                                                x.type == 'StandardMessageReceived') and
-                                            (MsgType.from_value(x['messageFlags']) == MsgType.ACK_OF_DIRECT or
-                                             MsgType.from_value(x['messageFlags']) == MsgType.NACK_OF_DIRECT))
-        ack_reply = Channel()
-
-        extras = [direct_ack_channel]
-        extras.extend(extra_channels)
-
-        port.write(msg, ack_reply_channel=ack_reply, custom_channels=extras)
+    # Extended messages for a batch of payloads, all with the same commands
+    def create_ext_many(self, cmd1, cmd2, payloads, flag=MsgType.DIRECT, large_checksum=False, port=None):
+        port = port if port else self._dev.port
+        return ExtMsgBuilder.get(port.defs).build_many(self._dev.address, cmd1, cmd2, payloads,
+                                                       flag, large_checksum)
+
+    # Sends the message and waits for the modem to echo it, and if wait_response
+    # is set for the device to ACK (or NACK) it. Returns the device's reply
+    async def _send(self, msg, wait_response, port, priority=1):
+        with port.write(msg, priority) as req:
+            if not await req.wait_success_fail(timeout=3):
+                if req.error:
+                    raise req.error
+                raise InsteonError('No IM reply to send command!')
+            if not wait_response:
+                return None
+
+            reply = await req.wait_until(lambda x: (x.type == 'ExtendedMessageReceived' or
+                                                    x.type == 'StandardMessageReceived') and
+                                                x['fromAddress'] == self._dev.address and
+                                                (MsgType.from_msg(x) == MsgType.ACK_OF_DIRECT or
+                                                 MsgType.from_msg(x) == MsgType.NACK_OF_DIRECT), timeout=4)
+            if not reply:
+                raise InsteonError('No response to {:02x} query received'.format(msg['command1']))
+            return reply
+
+    async def send_std(self, cmd1, cmd2, flag=MsgType.DIRECT,
+                        wait_response=False, port=None, priority=1):
+        port = port if port else self._dev.port
 
-        if not ack_reply.wait(3):
-            raise InsteonError('No IM reply to send command!')
+        msg = self.create_std(cmd1, cmd2, flag, port)
+        return await self._send(msg, wait_response, port, priority)
 
-        if wait_response:
-            if not direct_ack_channel.wait(4):
-                raise InsteonError('No response to extended query received')
+    async def query_std(self, cmd1, cmd2, flag=MsgType.DIRECT,
+                    wait_response=True, port=None, priority=1):
+        return await self.send_std(cmd1, cmd2, flag, wait_response, port, priority)
 
-        return direct_ack_channel
+    async def send_ext(self, cmd1, cmd2, data, flag=MsgType.DIRECT, large_checksum=False,
+                    wait_response=False, port=None, priority=1):
+        port = port if port else self._dev.port
 
-    def query_ext(self, cmd1, cmd2, data, flag=MsgType.DIRECT, large_checksum=False,
-                    wait_response=True, extra_channels=[], port=None):
-        return self.send_ext(cmd1, cmd2, data, flag, large_checksum, wait_response, extra_channels, port)
+        msg = self.create_ext(cmd1, cmd2, data, flag, large_checksum, port)
+        return await self._send(msg, wait_response, port, priority)
+
+    async def query_ext(self, cmd1, cmd2, data, flag=MsgType.DIRECT, large_checksum=False,
+                    wait_response=True, port=None, priority=1):
+        return await self.send_ext(cmd1, cmd2, data, flag, large_checksum, wait_response, port, priority)
+
+_chains = set()
+
+# Runs the queries for one device one after the other,
+# completing each query's future as it goes
+async def _query_chain(items, port, wait_response, priority):
+    try:
+        for query, future in items:
+            dev, cmd1, cmd2 = query[0], query[1], query[2]
+            try:
+                if len(query) > 3:
+                    reply = await dev.querier.query_ext(cmd1, cmd2, query[3], wait_response=wait_response,
+                                                        port=port, priority=priority)
+                else:
+                    reply = await dev.querier.query_std(cmd1, cmd2, wait_response=wait_response,
+                                                        port=port, priority=priority)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(reply)
+    finally:
+        # Whatever stopped the chain early (it being cancelled),
+        # nobody should be left waiting on the rest
+        for _, future in items:
+            future.cancel()
+
+# Sends a batch of (device, cmd1, cmd2) or (device, cmd1, cmd2, data) queries,
+# the latter as extended messages. Returns a future per query (in the same order)
+# which resolves to the device's reply or raises an InsteonError.
+# Different devices are queried at the same time, the queries
+# for any one device are sent in order, each after the last is answered
+def query_many(queries, port=None, wait_response=True, priority=1):
+    loop = asyncio.get_event_loop()
+    futures = []
+    by_device = {}
+    for q in queries:
+        f = loop.create_future()
+        futures.append(f)
+        by_device.setdefault(q[0].address, []).append((q, f))
+
+    for items in by_device.values():
+        dev_port = port if port else items[0][0][0].port
+        task = asyncio.ensure_future(_query_chain(items, dev_port, wait_response, priority))
+        # Hold on to the task until it is done
+        _chains.add(task)
+        task.add_done_callback(_chains.discard)
+    return futures
+
+# Like query_many(), but yields (query, future) pairs as the queries complete
+async def iter_many(queries, port=None, wait_response=True, priority=1):
+    queries = list(queries)
+    futures = query_many(queries, port, wait_response, priority)
+    pending = dict(zip(futures, queries))
+    while pending:
+        done, _ = await asyncio.wait(pending.keys(), return_when=asyncio.FIRST_COMPLETED)
+        for f in done:
+            yield pending.pop(f), f
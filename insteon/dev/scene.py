@@ -0,0 +1,230 @@
+import asyncio
+import collections
+import time
+
+from .linkgraph import LinkGraph
+from ..io.message import MsgType
+
+import logbook
+logger = logbook.Logger(__name__)
+
+"""
+Ties together the messages of a scene (group) activation:
+
+    1. the ALL-Link broadcast from the controller (or, if the modem is
+       the controller, our own SendALLLinkCommand)
+    2. an ALL-Link cleanup sent directly to each responder
+    3. the cleanup ACK (or NACK) from each responder
+    4. for modem scenes, the cleanup failure reports and the final
+       cleanup status report from the modem
+
+into one SceneEvent. The responders expected to answer come from the link
+graph, the event completes as soon as all of them have answered (or the
+modem reports the cleanup is done) rather than waiting out the timeout.
+Handlers registered with notify_scene() are called once per event, when it
+finishes either way.
+"""
+
+class SceneEvent:
+    def __init__(self, controller, group, cmd1, cmd2=0, expected=None):
+        self.controller = controller
+        self.group = group
+        self.cmd1 = cmd1
+        self.cmd2 = cmd2
+        self.expected = set(expected) if expected else set()
+        self.cleaned = set() # Responders sent a cleanup
+        self.acked = set()
+        self.nacked = set()
+
+        self.started = time.time()
+        self.finished = None
+        self.timed_out = False
+        self.status = None # The modem's cleanup status for modem scenes
+
+        self._timer = None
+
+    @property
+    def answered(self):
+        return self.acked | self.nacked
+
+    # Responders we expected an answer from but didn't get one
+    @property
+    def missing(self):
+        return self.expected - self.answered
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    # Every expected responder acknowledged
+    @property
+    def successful(self):
+        return self.done and not self.missing and not self.nacked
+
+    @property
+    def duration(self):
+        end = self.finished if self.finished is not None else time.time()
+        return end - self.started
+
+    def __str__(self):
+        return '{} group {} cmd {:02x}: {}/{} acked{}{}'.format(
+                    self.controller.human, self.group, self.cmd1,
+                    len(self.acked & self.expected) if self.expected else len(self.acked),
+                    len(self.expected) if self.expected else '?',
+                    ', {} nacked'.format(len(self.nacked)) if self.nacked else '',
+                    ' (timed out)' if self.timed_out else '')
+
+class SceneCorrelator:
+    def __init__(self, graph=None, modem_address=None, timeout=3, history=100):
+        self._graph = graph
+        self._modem_address = modem_address
+        self.timeout = timeout
+
+        self._open = {} # (controller, group) -> SceneEvent
+        self.events = collections.deque(maxlen=history) # Finished events, newest last
+        self._handlers = []
+        self._ports = []
+
+    @property
+    def graph(self):
+        return self._graph if self._graph else LinkGraph.bound()
+
+    @property
+    def modem_address(self):
+        if self._modem_address:
+            return self._modem_address
+        from .modem import Modem
+        modem = Modem.bound()
+        return modem.address if modem else None
+
+    @property
+    def open(self):
+        return list(self._open.values())
+
+    def notify_scene(self, h):
+        self._handlers.append(h)
+
+    def stop_notify_scene(self, h):
+        self._handlers.remove(h)
+
+    def attach(self, port):
+        port.notify_read(self._on_read)
+        port.notify_write(self._on_write)
+        self._ports.append(port)
+
+    def detach(self, port):
+        port.stop_notify_read(self._on_read)
+        port.stop_notify_write(self._on_write)
+        self._ports.remove(port)
+
+    # ---------------- Events -----------------
+
+    def _start(self, controller, group, cmd1, cmd2=0):
+        key = (controller, group)
+        old = self._open.get(key)
+        if old:
+            if old.cmd1 == cmd1:
+                return old
+            # A new command on the group ends the last one
+            self._finish(old)
+
+        graph = self.graph
+        expected = graph.responders(controller, group) if graph else set()
+        event = SceneEvent(controller, group, cmd1, cmd2, expected)
+        self._open[key] = event
+        event._timer = asyncio.get_event_loop().call_later(self.timeout, self._expire, event)
+        logger.trace('Scene started: {}', event)
+        return event
+
+    def _event(self, controller, group, cmd1=None):
+        event = self._open.get((controller, group))
+        if event is None:
+            # Stragglers of a scene that has just finished
+            for e in reversed(self.events):
+                if time.time() - e.finished > self.timeout:
+                    break
+                if e.controller == controller and e.group == group and \
+                        (cmd1 is None or e.cmd1 == cmd1):
+                    return e
+        if event is None and cmd1 is not None:
+            # Missed the start (or it was not for us to hear)
+            event = self._start(controller, group, cmd1)
+        return event
+
+    def _check(self, event):
+        if event.expected and not event.missing:
+            self._finish(event)
+
+    def _expire(self, event):
+        if event.done:
+            return
+        event.timed_out = bool(event.missing)
+        self._finish(event)
+
+    def _finish(self, event):
+        if event.done:
+            return
+        event.finished = time.time()
+        if event._timer:
+            event._timer.cancel()
+            event._timer = None
+        key = (event.controller, event.group)
+        if self._open.get(key) is event:
+            del self._open[key]
+        self.events.append(event)
+        logger.debug('Scene finished: {}', event)
+
+        for h in list(self._handlers):
+            h(event)
+
+    # ---------------- Traffic -----------------
+
+    def _on_write(self, msg):
+        if msg.type != 'SendALLLinkCommand':
+            return
+        modem = self.modem_address
+        if modem:
+            self._start(modem, msg['ALLLinkGroup'], msg['ALLLinkCommand'], msg['BroadcastCommand2'])
+
+    def _on_read(self, msg):
+        if msg.type == 'ALLLinkCleanupFailureReport':
+            modem = self.modem_address
+            event = self._open.get((modem, msg['ALLLinkGroup'])) if modem else None
+            if event:
+                event.nacked.add(msg['address'])
+                self._check(event)
+            return
+        if msg.type == 'ALLLinkCleanupStatusReport':
+            # The modem is done with the cleanups of its scene
+            modem = self.modem_address
+            for event in [e for e in self._open.values() if e.controller == modem]:
+                event.status = msg['statusByte']
+                self._finish(event)
+            return
+        if msg.type != 'StandardMessageReceived' and msg.type != 'ExtendedMessageReceived':
+            return
+
+        msg_type = MsgType.from_msg(msg)
+        if msg_type == MsgType.ALL_LINK_BROADCAST:
+            # The group is the low byte of the to address
+            self._start(msg['fromAddress'], msg['toAddress'].array[2],
+                        msg['command1'], msg['command2'])
+        elif msg_type == MsgType.ALL_LINK_CLEANUP:
+            event = self._event(msg['fromAddress'], msg['command2'], msg['command1'])
+            event.cleaned.add(msg['toAddress'])
+            # The modem answers the cleanups sent
+            # to it by itself, we never hear its ACK
+            if msg['toAddress'] == self.modem_address:
+                event.acked.add(msg['toAddress'])
+                self._check(event)
+        elif msg_type == MsgType.ALL_LINK_CLEANUP_ACK or \
+                msg_type == MsgType.ALL_LINK_CLEANUP_NACK:
+            # From the responder back to the controller
+            event = self._event(msg['toAddress'], msg['command2'])
+            if not event:
+                return
+            if msg_type == MsgType.ALL_LINK_CLEANUP_ACK:
+                event.acked.add(msg['fromAddress'])
+            else:
+                event.nacked.add(msg['fromAddress'])
+            self._check(event)
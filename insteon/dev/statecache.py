@@ -0,0 +1,325 @@
+import datetime
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from .linkdb import LinkRecord
+from .linkgraph import LinkGraph
+from ..io.address import Address
+from ..io.message import MsgType
+
+import logbook
+logger = logbook.Logger(__name__)
+
+_bound_cache = threading.local()
+
+"""
+The last known level (0-255) of every device, worked out from the
+traffic going past on a Port rather than by querying the devices.
+
+Levels are learned from:
+    - direct ACKs to on/off commands and status requests we sent
+    - ALL-Link broadcasts and cleanups sent by a device, which set the
+      level of the device itself (group 1) and, through the link graph
+      and the responders' link databases, of every device responding to it
+
+Each entry records when and how it was learned. The confidence says how
+much to trust it: a status reply is better than an ACK, which is better
+than a level inferred from someone else's broadcast. A manual dim leaves
+the level unknown until the device is queried again.
+"""
+
+# Confidence levels, higher is better
+UNKNOWN = 0
+INFERRED = 1
+ACKED = 2
+QUERIED = 3
+
+ON = 0x11
+FAST_ON = 0x12
+OFF = 0x13
+FAST_OFF = 0x14
+START_CHANGE = 0x17
+STOP_CHANGE = 0x18
+STATUS = 0x19
+
+# How long after sending a command its ACK is still matched to it
+ACK_WINDOW = 5
+
+class DeviceState:
+    def __init__(self, address, level=None, timestamp=None, confidence=UNKNOWN,
+                        source=None, changes=0, first_seen=None):
+        self.address = address
+        self.level = level
+        self.timestamp = timestamp # time.time() of the last update
+        self.confidence = confidence
+        self.source = source
+        self.changes = changes # Number of times the level was seen to change
+        self.first_seen = first_seen if first_seen is not None else timestamp
+
+    @property
+    def on(self):
+        return self.level is not None and self.level > 0
+
+    @property
+    def age(self):
+        return time.time() - self.timestamp if self.timestamp is not None else None
+
+    # Level changes per hour since the device was first seen
+    @property
+    def volatility(self):
+        if self.first_seen is None:
+            return 0
+        hours = max(time.time() - self.first_seen, 60) / 3600
+        return self.changes / hours
+
+    @property
+    def packed(self):
+        return {'address': self.address.packed, 'level': self.level,
+                'timestamp': self.timestamp, 'confidence': self.confidence,
+                'source': self.source, 'changes': self.changes,
+                'first_seen': self.first_seen}
+
+    @staticmethod
+    def unpack(packed):
+        return DeviceState(Address.unpack(packed['address']), packed.get('level'),
+                           packed.get('timestamp'), packed.get('confidence', UNKNOWN),
+                           packed.get('source'), packed.get('changes', 0),
+                           packed.get('first_seen'))
+
+    def __str__(self):
+        level = '{:3d}'.format(self.level) if self.level is not None else '  ?'
+        when = datetime.datetime.fromtimestamp(self.timestamp).strftime('%H:%M:%S') \
+                    if self.timestamp is not None else '--:--:--'
+        return '{} level {} at {} (confidence {}, {})'.format(self.address.human, level,
+                                                             when, self.confidence, self.source)
+
+class StateCache:
+    def __init__(self, network=None, graph=None):
+        self._network = network
+        self._graph = graph
+        self._states = {}
+        self._pending = {} # address -> (cmd1, cmd2, time sent)
+        self._ports = []
+        self._update_handlers = []
+
+    @property
+    def network(self):
+        if self._network:
+            return self._network
+        from .network import Network
+        return Network.bound()
+
+    @property
+    def graph(self):
+        return self._graph if self._graph else LinkGraph.bound()
+
+    # ---------------- Lookups -----------------
+
+    def __iter__(self):
+        for s in list(self._states.values()):
+            yield s
+
+    def __contains__(self, address):
+        return address in self._states
+
+    def get(self, address):
+        return self._states.get(address)
+
+    def level(self, address):
+        state = self._states.get(address)
+        return state.level if state else None
+
+    # States older than max_age seconds (or never seen at all, for
+    # the addresses given) or less certain than min_confidence
+    def stale(self, max_age, min_confidence=INFERRED, addresses=None):
+        stale = []
+        for addr in (addresses if addresses is not None else self._states.keys()):
+            s = self._states.get(addr)
+            if not s or s.age is None or s.age > max_age or s.confidence < min_confidence:
+                stale.append(addr)
+        return stale
+
+    def notify_update(self, h):
+        self._update_handlers.append(h)
+
+    def stop_notify_update(self, h):
+        self._update_handlers.remove(h)
+
+    # ---------------- Updates -----------------
+
+    def set(self, address, level, confidence, source=None, timestamp=None):
+        timestamp = timestamp if timestamp is not None else time.time()
+        state = self._states.get(address)
+        if not state:
+            state = DeviceState(address, first_seen=timestamp)
+            self._states[address] = state
+        elif level is not None and state.level is not None and level != state.level:
+            state.changes += 1
+        if level is not None:
+            state.level = level
+        state.timestamp = timestamp
+        state.confidence = confidence
+        state.source = source
+
+        for h in list(self._update_handlers):
+            h(state)
+        return state
+
+    # The level was changed by an unknown amount
+    def invalidate(self, address, source=None):
+        state = self._states.get(address)
+        if state:
+            state.changes += 1
+        self.set(address, None, UNKNOWN, source)
+
+    def clear(self):
+        self._states.clear()
+        self._pending.clear()
+
+    # ---------------- Traffic -----------------
+
+    def attach(self, port):
+        port.notify_write(self._on_write)
+        port.notify_read(self._on_read)
+        self._ports.append(port)
+
+    def attached(self, port):
+        return port in self._ports
+
+    def detach(self, port):
+        port.stop_notify_write(self._on_write)
+        port.stop_notify_read(self._on_read)
+        self._ports.remove(port)
+
+    def _on_write(self, msg):
+        if msg.type != 'SendStandardMessage' and msg.type != 'SendExtendedMessage':
+            return
+        if MsgType.from_msg(msg) != MsgType.DIRECT:
+            return
+        self._pending[msg['toAddress']] = (msg['command1'], msg['command2'], time.time())
+
+    def _on_read(self, msg):
+        if msg.type != 'StandardMessageReceived' and msg.type != 'ExtendedMessageReceived':
+            return
+        msg_type = MsgType.from_msg(msg)
+        sender = msg['fromAddress']
+
+        if msg_type == MsgType.ACK_OF_DIRECT:
+            self._on_ack(sender, msg)
+        elif msg_type == MsgType.NACK_OF_DIRECT:
+            self._pending.pop(sender, None)
+        elif msg_type == MsgType.ALL_LINK_BROADCAST:
+            # The group is the low byte of the to address
+            self._on_group(sender, msg['toAddress'].array[2], msg['command1'])
+        elif msg_type == MsgType.ALL_LINK_CLEANUP:
+            self._on_group(sender, msg['command2'], msg['command1'])
+
+    def _on_ack(self, sender, msg):
+        pending = self._pending.pop(sender, None)
+        if not pending or time.time() - pending[2] > ACK_WINDOW:
+            return
+        cmd1, cmd2, _ = pending
+        if cmd1 == STATUS:
+            # The status ACK has the level in command2
+            # (and the db delta in command1)
+            self.set(sender, msg['command2'], QUERIED, 'status')
+        elif cmd1 == ON:
+            self.set(sender, cmd2, ACKED, 'on')
+        elif cmd1 == FAST_ON:
+            self.set(sender, 0xFF, ACKED, 'fast on')
+        elif cmd1 == OFF or cmd1 == FAST_OFF:
+            self.set(sender, 0x00, ACKED, 'off')
+
+    # A controller sent a group command
+    def _on_group(self, controller, group, cmd1):
+        if cmd1 == START_CHANGE or cmd1 == STOP_CHANGE:
+            level = None
+        elif cmd1 == ON or cmd1 == FAST_ON:
+            level = 0xFF
+        elif cmd1 == OFF or cmd1 == FAST_OFF:
+            level = 0x00
+        else:
+            return
+        source = 'group {} of {}'.format(group, controller.human)
+
+        # Group 1 is the device's own load
+        if group == 1:
+            self._apply(controller, level, ACKED, source)
+
+        graph = self.graph
+        if not graph:
+            return
+        for responder in graph.responders(controller, group):
+            if level and cmd1 == ON:
+                self._apply(responder, self._on_level(responder, controller, group),
+                            INFERRED, source)
+            else:
+                self._apply(responder, level, INFERRED, source)
+
+    def _apply(self, address, level, confidence, source):
+        if level is None:
+            self.invalidate(address, source)
+        else:
+            self.set(address, level, confidence, source)
+
+    # The level the responder goes to when the controller turns the group on,
+    # stored in the first data byte of the responder's link record
+    def _on_level(self, responder, controller, group):
+        network = self.network
+        dev = network.get_by_address(responder) if network else None
+        if dev and hasattr(dev, 'db'):
+            for r in dev.db.cache.filter(LinkRecord(address=controller, group=group)):
+                if r.active and r.responder and r.data:
+                    return r.data[0]
+        return 0xFF
+
+    # ---------------- Snapshots -----------------
+
+    @property
+    def packed(self):
+        return {'states': [s.packed for s in self._states.values()]}
+
+    def update(self, packed):
+        for p in packed.get('states', []):
+            s = DeviceState.unpack(p)
+            self._states[s.address] = s
+
+    def save(self, filename):
+        with open(filename, 'w') as out:
+            json.dump(self.packed, out)
+
+    def load(self, filename):
+        with open(filename, 'r') as i:
+            self.update(json.load(i))
+
+    def print(self):
+        for s in self._states.values():
+            print(s)
+
+    def bind(self):
+        stack = getattr(_bound_cache, 'stack', None)
+        if not stack:
+            stack = []
+            _bound_cache.stack = stack
+        stack.append(self)
+
+    def unbind(self):
+        stack = getattr(_bound_cache, 'stack', None)
+        if stack:
+            stack.remove(self)
+
+    @contextmanager
+    def use(self):
+        self.bind()
+        yield
+        self.unbind()
+
+    @staticmethod
+    def bound():
+        stack = getattr(_bound_cache, 'stack', None)
+        if stack:
+            return stack[-1]
+        else:
+            return None
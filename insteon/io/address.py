@@ -1,5 +1,7 @@
 
 class Address:
+    __slots__ = ('_hi', '_mid', '_low')
+
     def __init__(self, hi=0, mid=0, low=0):
         self._hi = hi;
         self._mid = mid;
@@ -0,0 +1,125 @@
+import asyncio
+import collections
+import time
+
+from ..util import InsteonError
+
+import logbook
+logger = logbook.Logger(__name__)
+
+"""
+Admission control for a Port's queue. Without it anything can queue up
+any number of requests and everything behind them just waits.
+
+Limits can be set on the number of requests queued by any one client
+(the client passed to Port.write()) and at any one priority. When a
+limit is hit the new request is either rejected straight away (write()
+raises RequestRejected) or, with REPLACE_OLDEST, the oldest queued request
+of the same client/priority is dropped to make room.
+
+max_age sheds requests that have waited too long to still be of any use
+(the writer aborts them with RequestRejected instead of writing them).
+It can be a number of seconds for everything or a dict by priority.
+"""
+
+class RequestRejected(InsteonError):
+    pass
+
+class Admission:
+    REJECT = 'reject'
+    REPLACE_OLDEST = 'replace oldest'
+
+    def __init__(self, per_client=None, per_priority=None, max_age=None, policy=REJECT):
+        self.per_client = per_client
+        self.per_priority = per_priority if per_priority else {}
+        self.max_age = max_age
+        self.policy = policy
+
+        self.rejected = 0
+        self.replaced = 0
+        self.shed = 0
+
+        # (kind, value) -> queued requests oldest first
+        self._queued = {}
+
+    def clear(self):
+        self._queued.clear()
+
+    def queued(self, client=None, priority=None):
+        if client is not None:
+            return len(self._queued.get(('client', client), ()))
+        if priority is not None:
+            return len(self._queued.get(('priority', priority), ()))
+        return sum(len(q) for k, q in self._queued.items() if k[0] == 'priority')
+
+    def _max_age(self, priority):
+        if isinstance(self.max_age, dict):
+            return self.max_age.get(priority)
+        return self.max_age
+
+    def expired(self, req, now=None):
+        max_age = self._max_age(req.priority)
+        if max_age is None:
+            return False
+        now = now if now is not None else time.time()
+        if now - req.queued_at > max_age:
+            self.shed += 1
+            logger.debug('Shedding request queued {:.1f}s ago: {}', now - req.queued_at, req.message)
+            return True
+        return False
+
+    def _classes(self, req):
+        classes = [(('priority', req.priority), self.per_priority.get(req.priority))]
+        if req.client is not None:
+            classes.append((('client', req.client), self.per_client))
+        return classes
+
+    # Drops a queued request without it ever being written
+    def _drop(self, req, error):
+        self.taken(req)
+        # Mark it straight away so the writer skips it,
+        # the waiters get woken up by abort()
+        req.error = error
+        asyncio.ensure_future(req.abort(error))
+
+    # Makes room for expired requests first
+    def _shed_expired(self, key):
+        queued = self._queued.get(key)
+        now = time.time()
+        while queued and self.expired(queued[0], now):
+            self._drop(queued[0], RequestRejected('Request shed after waiting {:.1f}s in the queue'.format(
+                                                        now - queued[0].queued_at)))
+
+    # Raises RequestRejected if the request can't be queued
+    def admit(self, req):
+        classes = self._classes(req)
+        for key, limit in classes:
+            if limit is None:
+                continue
+            self._shed_expired(key)
+            queued = self._queued.get(key, ())
+            if len(queued) < limit:
+                continue
+            if self.policy == Admission.REPLACE_OLDEST and queued:
+                while len(queued) >= limit and queued:
+                    self.replaced += 1
+                    self._drop(queued[0], RequestRejected('Replaced by a newer request'))
+            else:
+                self.rejected += 1
+                raise RequestRejected('Too many requests queued for {} {}'.format(*key))
+
+        for key, _ in classes:
+            self._queued.setdefault(key, collections.deque()).append(req)
+
+    # The request left the queue (to be written or moved elsewhere)
+    def taken(self, req):
+        for key, _ in self._classes(req):
+            queued = self._queued.get(key)
+            if queued is None:
+                continue
+            try:
+                queued.remove(req)
+            except ValueError:
+                pass
+            if not queued:
+                del self._queued[key]
@@ -0,0 +1,231 @@
+import asyncio
+import os
+import time
+
+from . import message
+from .message import MsgType, Direction
+from .port import Port
+from .admission import RequestRejected
+
+import logbook
+logger = logbook.Logger(__name__)
+
+"""
+The broker owns the modem connection through a Port and lets any
+number of local processes share it over a unix socket. Clients speak
+the raw PLM framing in both directions, exactly as if they had the
+serial port to themselves.
+
+Replies to a client's command (the PLM echo and the direct ACK/NACK from
+the device) go back only to the client that sent the command,
+everything else is broadcast to all the clients.
+"""
+
+class BrokerClient:
+    def __init__(self, broker, reader, writer, max_buffer=64*1024):
+        self._broker = broker
+        self._reader = reader
+        self._writer = writer
+        self.max_buffer = max_buffer
+        self._decoder = message.MsgDecoder(broker.port.defs, Direction.TO_MODEM)
+
+    @property
+    def closed(self):
+        return self._writer.is_closing()
+
+    def close(self):
+        self._writer.close()
+
+    def send(self, msg):
+        if self.closed:
+            return
+        # A client that stopped reading would have the broker
+        # buffering everything for it forever, cut it off instead
+        if self._writer.transport.get_write_buffer_size() > self.max_buffer:
+            logger.warning('Broker client is not keeping up, disconnecting it')
+            self.close()
+            return
+        self._writer.write(msg.bytes)
+
+    async def run(self, read_size=256):
+        try:
+            while True:
+                buf = await self._reader.read(read_size)
+                if not buf:
+                    break
+                msg = self._decoder.decode(buf)
+                while msg:
+                    self._broker.submit(self, msg)
+                    msg = self._decoder.decode(bytes())
+        except ConnectionError:
+            pass
+        finally:
+            self._writer.close()
+
+# A command from a client that is still waiting
+# on its echo or direct ack
+class PendingReply:
+    def __init__(self, client, req, ack_timeout):
+        self.client = client
+        self.request = req
+        self.echoed = False
+        self.ack_timeout = ack_timeout
+        self.expires = None
+        self.written_at = None
+
+        msg = req.message
+        self.direct = 'toAddress' in msg and \
+                MsgType.from_msg(msg) == MsgType.DIRECT
+        self.to_address = msg['toAddress'] if 'toAddress' in msg else None
+
+    @property
+    def expired(self):
+        now = time.time()
+        if self.expires is None and self.request.written.is_set():
+            # Give up on commands the modem never echoed
+            if self.written_at is None:
+                self.written_at = now
+            return now > self.written_at + self.ack_timeout
+        return self.expires is not None and now > self.expires
+
+    # Returns True if the message belongs to this command
+    def claim(self, msg):
+        if not self.echoed:
+            if msg.type == 'PureNACK':
+                # The modem wasn't ready, the client is
+                # responsible for resending
+                self.request.fail()
+                self.expires = time.time()
+                return True
+            if msg.type == self.request.message.type + 'Reply':
+                self.echoed = True
+                self.request.success()
+                if self.direct and msg['ACK/NACK'] == 0x06:
+                    self.expires = time.time() + self.ack_timeout
+                else:
+                    self.expires = time.time()
+                return True
+            return False
+
+        if self.direct and not self.expired and \
+                'fromAddress' in msg and msg['fromAddress'] == self.to_address and \
+                MsgType.from_msg(msg) in (MsgType.ACK_OF_DIRECT, MsgType.NACK_OF_DIRECT):
+            self.expires = time.time()
+            return True
+        return False
+
+class Broker:
+    def __init__(self, port, path, ack_timeout=3, write_retries=1, write_timeout=1,
+                        max_client_buffer=64*1024):
+        self.port = port
+        self._max_client_buffer = max_client_buffer
+        self._path = path
+        self._ack_timeout = ack_timeout
+        self._write_retries = write_retries
+        self._write_timeout = write_timeout
+
+        self._clients = []
+        # Oldest first, the same order the port writes them in
+        self._pending = []
+
+        self._server = None
+
+    @property
+    def clients(self):
+        return list(self._clients)
+
+    async def start(self):
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self.port.notify_read(self._on_read)
+        self._server = await asyncio.start_unix_server(self._on_client, path=self._path)
+        logger.info('Broker listening on {}', self._path)
+
+    async def stop(self):
+        self.port.stop_notify_read(self._on_read)
+        for c in self.clients:
+            c.close()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    def submit(self, client, msg):
+        # The clients handle their own resends
+        try:
+            req = self.port.write(msg, retries=self._write_retries,
+                                       timeout=self._write_timeout, client=client)
+        except RequestRejected as e:
+            logger.debug('Broker client command rejected: {}', e)
+            client.send(self._nack(msg))
+            return
+        self._pending.append(PendingReply(client, req, self._ack_timeout))
+
+    # What the modem answers when it can't take a command right now,
+    # the command echoed back with a NACK, which has the client resend it
+    def _nack(self, msg):
+        defs = self.port.defs
+        raw = msg.bytes
+        reply_def = defs.get(msg.type + 'Reply')
+        # Replies carrying more than the echo (e.g. GetIMInfoReply)
+        # can't be NACKed in a way our decoders would read back
+        if reply_def is None or reply_def.length != len(raw) + 1:
+            return defs['PureNACK'].create()
+        return reply_def.deserialize(raw + bytes([0x15]))
+
+    async def _on_client(self, reader, writer):
+        client = BrokerClient(self, reader, writer, self._max_client_buffer)
+        self._clients.append(client)
+        logger.debug('Broker client connected ({} total)', len(self._clients))
+        try:
+            await client.run()
+        finally:
+            self._clients.remove(client)
+            self._pending = [p for p in self._pending if p.client is not client]
+            logger.debug('Broker client disconnected ({} total)', len(self._clients))
+
+    def _on_read(self, msg):
+        self._pending = [p for p in self._pending if not p.expired]
+
+        for p in self._pending:
+            if p.claim(msg):
+                p.client.send(msg)
+                return
+
+        for c in self._clients:
+            c.send(msg)
+
+def run():
+    from . import serial
+    from . import xmlmsgreader
+
+    path = '/tmp/insteon-broker.sock'
+    port = Port(xmlmsgreader.read_default_xml())
+    broker = Broker(port, path)
+    conn = serial.SerialConn('/dev/ttyUSB0')
+
+    async def main():
+        port.start(conn)
+        try:
+            await broker.serve_forever()
+        finally:
+            await port.stop()
+
+    print('Broker started on {}'.format(path))
+    try:
+        asyncio.get_event_loop().run_until_complete(main())
+    except KeyboardInterrupt:
+        print('Received interrupt, shutting down broker')
+    conn.close()
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,274 @@
+import bisect
+import concurrent.futures
+import mmap
+
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError('insteon.io.bulkdecode needs numpy (pip install insteon[capture])')
+
+from .message import DataType, Direction
+
+"""
+Decodes raw modem traffic (e.g. days of captured serial bytes) into
+columns in one go instead of running it through a MsgDecoder one Msg at
+a time.
+
+Every 0x02 that is followed by a known command byte (and whose header
+passes the filters of a message definition) is a candidate frame start.
+Classifying the candidates and pulling out the fields is all done on
+whole arrays. Following the chain of frames (each frame starts where the
+last one ended, skipping garbage up to the next candidate, the same as
+the MsgDecoder does) is a loop, but only over the places where the chain
+doesn't just run on to the next candidate.
+
+The result is a numpy structured array with one row per frame:
+
+    offset  where the frame starts in the capture
+    time    when it was read (NaN without timestamps, see decode())
+    type    index into BulkDecoder.types (the message definition name)
+    from    fromAddress, packed as hi << 16 | mid << 8 | low (0 if none)
+    to      toAddress, packed the same way
+    flags, cmd1, cmd2
+    data    userData1 to 14 (zeros for standard messages)
+
+Fields the message doesn't have are 0. Needs numpy, which the core
+package doesn't depend on.
+"""
+
+DTYPE = np.dtype([('offset', '<u8'), ('time', '<f8'), ('type', 'u1'),
+                  ('from', '<u4'), ('to', '<u4'),
+                  ('flags', 'u1'), ('cmd1', 'u1'), ('cmd2', 'u1'),
+                  ('data', 'u1', (14,))])
+
+_COLUMNS = {'fromAddress': 'from', 'toAddress': 'to', 'messageFlags': 'flags',
+            'command1': 'cmd1', 'command2': 'cmd2'}
+
+def pack_address(addr):
+    hi, mid, low = addr.array
+    return (hi << 16) | (mid << 8) | low
+
+def unpack_address(value):
+    from .address import Address
+    value = int(value)
+    return Address((value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF)
+
+class BulkDecoder:
+    def __init__(self, defs, direction=Direction.FROM_MODEM):
+        # Only plain data is kept from the definitions (their
+        # filters are lambdas), so the decoder can be pickled
+        msg_defs = [d for d in defs.values() if d.direction == direction]
+        self.types = [d.name for d in msg_defs]
+        self._lengths = np.array([d.length for d in msg_defs], dtype=np.int64)
+        self._header_lengths = [d.header_length for d in msg_defs]
+        self.max_length = int(self._lengths.max())
+
+        # Every frame starts with the same byte, the command byte picks the
+        # definition (or definitions, when later header fields tell them apart)
+        starts = {d.fields_list[0].default_value for d in msg_defs}
+        if len(starts) != 1:
+            raise ValueError('Message definitions do not share a start byte')
+        self.start_byte = starts.pop()
+
+        self._by_cmd = {}
+        for i, d in enumerate(msg_defs):
+            self._by_cmd.setdefault(d.fields_list[1].default_value, []).append(i)
+
+        # column -> (offset, is address) for every definition
+        self._columns = [{column: (d[name].offset, d[name].type == DataType.ADDRESS)
+                            for name, column in _COLUMNS.items() if name in d} for d in msg_defs]
+        self._data = [d['userData1'].offset if 'userData1' in d else None for d in msg_defs]
+
+        # Header filters as lookup tables over all byte values
+        self._filters = []
+        for d in msg_defs:
+            tables = []
+            for f in d.fields_list[2:]:
+                if f.offset >= d.header_length or f.header_filter is None or \
+                        f.type != DataType.BYTE:
+                    continue
+                tables.append((f.offset, np.array([bool(f.header_filter(v)) for v in range(256)])))
+            self._filters.append(tables)
+
+    def type_index(self, name):
+        return self.types.index(name)
+
+    # Candidate frame starts in buf[start:stop] and the definition
+    # index of each. Frames cut off by the end of buf are included, a
+    # header too short to tell definitions apart goes to the first one
+    def _candidates(self, buf, start, stop):
+        n = len(buf)
+        # A frame starting before stop may run past it
+        end = min(stop + self.max_length, n)
+        pos = np.flatnonzero(buf[start:min(stop, n - 1)] == self.start_byte) + start
+        cmds = buf[np.minimum(pos + 1, end - 1)]
+        kinds = np.full(len(pos), -1, dtype=np.int64)
+
+        for cmd, indices in self._by_cmd.items():
+            sel = np.flatnonzero(cmds == cmd)
+            if not len(sel):
+                continue
+            for i in indices:
+                ok = np.ones(len(sel), dtype=bool)
+                for offset, table in self._filters[i]:
+                    ok &= table[buf[np.minimum(pos[sel] + offset, end - 1)]]
+                ok |= pos[sel] + self._header_lengths[i] > n
+                hit = sel[ok & (kinds[sel] < 0)]
+                kinds[hit] = i
+
+        found = kinds >= 0
+        return pos[found], kinds[found]
+
+    # Follows the chain of frames starting in buf[start:stop], returns
+    # the frame offsets, their definition indices and where the last
+    # frame ends
+    def frames(self, buf, start=0, stop=None):
+        buf = _as_array(buf)
+        stop = len(buf) if stop is None else min(stop, len(buf))
+        pos, kinds = self._candidates(buf, start, stop)
+        if not len(pos):
+            return pos, kinds, start
+
+        # The candidate following each one, a frame overlapping
+        # the next candidate means that one was in its payload
+        ends = pos + self._lengths[kinds]
+        nxt = np.searchsorted(pos, ends)
+
+        # Mostly one frame follows right on from the last, the chain
+        # only has to be walked where it skips a candidate or some garbage
+        m = len(pos)
+        breaks = nxt != np.arange(1, m + 1)
+        breaks[-1] = True
+        breaks = np.flatnonzero(breaks).tolist()
+        nxt = nxt.tolist()
+        runs = np.zeros(m + 1, dtype=np.int64)
+        i = 0
+        while i < m:
+            b = breaks[bisect.bisect_left(breaks, i)]
+            runs[i] += 1
+            runs[b + 1] -= 1
+            i = nxt[b]
+        chain = np.flatnonzero(np.cumsum(runs[:m]) > 0)
+
+        # A frame cut off by the end of the capture ends the chain, the
+        # MsgDecoder would still be waiting for the rest of it
+        cut = np.flatnonzero(ends[chain] > len(buf))
+        if len(cut):
+            chain = chain[:cut[0]]
+            if not len(chain):
+                return pos[chain], kinds[chain], start
+        return pos[chain], kinds[chain], int(ends[chain[-1]])
+
+    # Decodes the frames starting in buf[start:stop]. marks are optional
+    # (offset, time) pairs, sorted by offset, saying when the bytes from
+    # that offset on were read, every frame gets the time of the last mark
+    # at or before it
+    def decode(self, buf, marks=None, start=0, stop=None):
+        buf = _as_array(buf)
+        pos, kinds, _ = self.frames(buf, start, stop)
+        return self.columns(buf, pos, kinds, marks)
+
+    # Pulls the fields of the frames at pos out of buf
+    def columns(self, buf, pos, kinds, marks=None):
+        buf = _as_array(buf)
+        out = np.zeros(len(pos), dtype=DTYPE)
+        out['offset'] = pos
+        out['type'] = kinds
+        out['time'] = _times(pos, marks)
+
+        for i in np.unique(kinds).tolist():
+            sel = np.flatnonzero(kinds == i)
+            at = pos[sel]
+            for column, (offset, is_address) in self._columns[i].items():
+                o = at + offset
+                if is_address:
+                    out[column][sel] = (buf[o].astype(np.uint32) << 16) | \
+                                       (buf[o + 1].astype(np.uint32) << 8) | buf[o + 2]
+                else:
+                    out[column][sel] = buf[o]
+            if self._data[i] is not None:
+                o = at[:, None] + self._data[i] + np.arange(14)
+                out['data'][sel] = buf[o]
+        return out
+
+    # Decodes a whole capture file, memory mapped. With more than one
+    # worker the file is split into segments of segment_size bytes that
+    # are decoded in a process pool (see _merge() for how they are put
+    # back together)
+    def decode_file(self, filename, marks=None, workers=1, segment_size=64 << 20):
+        with open(filename, 'rb') as f:
+            size = f.seek(0, 2)
+            if not size:
+                return np.zeros(0, dtype=DTYPE)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                buf = np.frombuffer(m, dtype=np.uint8)
+                try:
+                    if workers <= 1 or size <= segment_size:
+                        return self.decode(buf, marks)
+                    segments = [(s, min(s + segment_size, size)) for s in range(0, size, segment_size)]
+                    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker,
+                                                initargs=(self, filename)) as pool:
+                        parts = list(pool.map(_decode_segment, segments,
+                                              chunksize=max(1, len(segments) // (4 * workers))))
+                    out = self._merge(buf, segments, parts)
+                    out['time'] = _times(out['offset'], marks)
+                    return out
+                finally:
+                    # Let go of the mapping before it is closed
+                    del buf
+
+    # Every segment was decoded as if the chain of frames started at the
+    # first candidate in it. The real chain picks up where the last frame
+    # of the segment before ended, usually that is the same frame, if not
+    # the real chain is walked until it runs into a frame of the segment
+    # (from there on they are the same)
+    def _merge(self, buf, segments, parts):
+        merged = []
+        expected = 0 # Where the next frame can start at the earliest
+        for (_, stop), (cols, end) in zip(segments, parts):
+            offsets = cols['offset']
+            while True:
+                k = np.searchsorted(offsets, expected)
+                until = int(offsets[k]) + 1 if k < len(offsets) else stop
+                pos, kinds, local_end = self.frames(buf, expected, until)
+                if not len(pos):
+                    break
+                if k < len(offsets) and pos[-1] == offsets[k]:
+                    merged.append(self.columns(buf, pos[:-1], kinds[:-1]))
+                    merged.append(cols[k:])
+                    expected = end
+                    break
+                # Out of step, keep walking
+                merged.append(self.columns(buf, pos, kinds))
+                expected = local_end
+                if k >= len(offsets):
+                    break
+        return np.concatenate(merged) if merged else np.zeros(0, dtype=DTYPE)
+
+# Every worker maps the file itself instead of being sent the bytes
+_worker = None
+
+def _init_worker(decoder, filename):
+    global _worker
+    f = open(filename, 'rb')
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _worker = (decoder, np.frombuffer(m, dtype=np.uint8))
+
+def _decode_segment(segment):
+    decoder, buf = _worker
+    pos, kinds, end = decoder.frames(buf, *segment)
+    return decoder.columns(buf, pos, kinds), end
+
+def _as_array(buf):
+    if isinstance(buf, np.ndarray):
+        return buf
+    return np.frombuffer(buf, dtype=np.uint8)
+
+def _times(pos, marks):
+    if marks is None or not len(marks):
+        return np.full(len(pos), np.nan)
+    marks = np.asarray(marks, dtype=np.float64)
+    i = np.searchsorted(marks[:, 0], pos, side='right') - 1
+    times = marks[np.maximum(i, 0), 1]
+    times[i < 0] = np.nan
+    return times
@@ -0,0 +1,81 @@
+import weakref
+
+from . import message
+from .message import MsgType
+from ..util import InsteonError, calc_simple_crc, calc_long_crc
+
+"""
+Builds SendExtendedMessage frames straight into a byte buffer instead of
+setting the 20 or so fields of a Msg one at a time and serializing them.
+
+The frame layout comes from the message definition, the builder copies a
+template frame (with the start byte and command filled in) and drops the
+address, flags, commands and payload in at their offsets. The Msgs handed
+back carry the finished frame, their fields are only decoded if something
+looks at them.
+"""
+
+_builders = weakref.WeakKeyDictionary()
+
+class ExtMsgBuilder:
+    def __init__(self, msg_def):
+        self._def = msg_def
+        self.length = msg_def.length
+        self._template = bytes(msg_def.serialize(msg_def.create()))
+        self._addr = msg_def['toAddress'].offset
+        self._flags = msg_def['messageFlags'].offset
+        self._cmd1 = msg_def['command1'].offset
+        self._cmd2 = msg_def['command2'].offset
+        self._data = msg_def['userData1'].offset
+
+    # One builder per set of definitions
+    @staticmethod
+    def get(defs):
+        msg_def = defs['SendExtendedMessage']
+        builder = _builders.get(msg_def)
+        if builder is None:
+            builder = ExtMsgBuilder(msg_def)
+            _builders[msg_def] = builder
+        return builder
+
+    # Fills in a frame at offset o of buf (which has to be preallocated),
+    # data is the payload without the checksum (up to 13 bytes, 12 with large_checksum)
+    def build_into(self, buf, o, to_address, cmd1, cmd2, data,
+                        flag=MsgType.DIRECT, large_checksum=False):
+        if large_checksum and len(data) > 12 or len(data) > 13:
+            raise InsteonError('Cannot send more than 12 or 13 bytes in an ext message')
+
+        n = self.length
+        buf[o:o + n] = self._template
+        buf[o + self._addr:o + self._addr + 3] = to_address.bytes
+        buf[o + self._flags] = flag.value | (1 << 4) | 0xf
+        buf[o + self._cmd1] = cmd1
+        buf[o + self._cmd2] = cmd2
+        d = o + self._data
+        buf[d:d + len(data)] = bytes(data)
+
+        # The checksum covers the commands and the whole
+        # payload (unused bytes being 0)
+        checked = buf[o + self._cmd1:d + (12 if large_checksum else 13)]
+        if large_checksum:
+            crc = calc_long_crc(checked)
+            buf[d + 12] = crc & 0xFF
+            buf[d + 13] = (crc >> 8) & 0xFF
+        else:
+            buf[d + 13] = calc_simple_crc(checked)
+
+    def build(self, to_address, cmd1, cmd2, data, flag=MsgType.DIRECT, large_checksum=False):
+        buf = bytearray(self.length)
+        self.build_into(buf, 0, to_address, cmd1, cmd2, data, flag, large_checksum)
+        return message.Msg(self._def, raw=bytes(buf))
+
+    # Builds a frame for every payload in one go (e.g. the
+    # 0x2f writes of a whole link database), returns a list of Msgs
+    def build_many(self, to_address, cmd1, cmd2, payloads, flag=MsgType.DIRECT, large_checksum=False):
+        n = self.length
+        payloads = list(payloads)
+        buf = bytearray(n * len(payloads))
+        for i, data in enumerate(payloads):
+            self.build_into(buf, i*n, to_address, cmd1, cmd2, data, flag, large_checksum)
+        view = memoryview(buf)
+        return [message.Msg(self._def, raw=bytes(view[i*n:(i + 1)*n])) for i in range(len(payloads))]
@@ -0,0 +1,327 @@
+import array
+import bisect
+import mmap
+import os
+import struct
+import time
+
+from . import message
+from . import xmlmsgreader
+from .message import Direction, MsgType
+
+import logbook
+logger = logbook.Logger(__name__)
+
+"""
+A persistent, indexed log of the traffic through a port, to look back
+over weeks of it (e.g. what turned the lights on at 3am) without keeping
+it in memory or grepping through logs.
+
+Messages are appended to a memory-mapped log of fixed size records (the
+time they were seen and the raw frame), so record n is at a known offset.
+Records are only ever appended with increasing times, so the log is its
+own time index and a time range is found by bisecting it. Next to it are
+two indices of record numbers:
+
+    <path>.addr  every record by the addresses in it (from, to, link
+                 addresses, ...), kept in memory as one array per address
+    <path>.btn   the records that are button events (ALL-Link broadcasts
+                 of the on/off/dim commands and the modem's set button)
+
+The indices are written out on flush()/close(). If they were not (e.g. a
+crash) the records they are missing are indexed again when the log is
+opened.
+"""
+
+_MAGIC = b'INSTHIST'
+_VERSION = 1
+_HEADER = struct.Struct('<8sHHQQ') # magic, version, record size, count, records indexed
+_HEADER_SIZE = 64
+_RECORD = struct.Struct('<dBB30s') # time, direction (| _DUPLICATE), length, raw frame
+_TIME = struct.Struct('<d')
+_ADDR_ENTRY = struct.Struct('<II') # packed address, record
+_BTN_ENTRY = struct.Struct('<I')
+
+_DIRECTIONS = {Direction.FROM_MODEM: 0, Direction.TO_MODEM: 1}
+_DUPLICATE = 0x80 # Set on the direction of messages a DuplicateFilter tagged
+
+# Group commands that come from someone pushing a button
+BUTTON_COMMANDS = {0x11, 0x12, 0x13, 0x14, 0x17, 0x18}
+
+def _pack_address(addr):
+    hi, mid, low = addr.array
+    return (hi << 16) | (mid << 8) | low
+
+class TrafficHistory:
+    def __init__(self, path, defs=None, grow=16384):
+        self.path = path
+        self.defs = defs if defs is not None else xmlmsgreader.read_default_xml()
+        self.grow = grow # Records to grow the log by at a time
+
+        # Definitions by direction and command byte
+        # to find the definition of a record again
+        self._by_cmd = {}
+        for d in self.defs.values():
+            if d.direction in _DIRECTIONS:
+                cmd = d.fields_list[1].default_value
+                self._by_cmd.setdefault((_DIRECTIONS[d.direction], cmd), []).append(d)
+
+        self._file = None
+        self._map = None
+        self._count = 0
+        self._capacity = 0
+        self._indexed = 0 # Records the index files covered at the last flush
+        self._last_time = 0
+        self._ports = {} # port -> whether writes are recorded
+
+        self._addresses = {} # packed address -> array of records
+        self._buttons = array.array('I')
+        self._addr_file = None
+        self._btn_file = None
+
+        self.open()
+
+    # ---------------- Files -----------------
+
+    def open(self):
+        if self._file:
+            return
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) >= _HEADER_SIZE
+        self._file = open(self.path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self._file.truncate(_HEADER_SIZE + self.grow * _RECORD.size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._capacity = (len(self._map) - _HEADER_SIZE) // _RECORD.size
+
+        if exists:
+            magic, version, size, count, indexed = _HEADER.unpack_from(self._map, 0)
+            if magic != _MAGIC or version != _VERSION or size != _RECORD.size:
+                self._close_map()
+                raise IOError('{} is not a traffic history'.format(self.path))
+            self._count = min(count, self._capacity)
+            self._indexed = min(indexed, self._count)
+            self._last_time = self.time_of(self._count - 1) if self._count else 0
+        else:
+            self._count = 0
+            self._indexed = 0
+            self._write_header()
+
+        self._load_indices()
+
+    def _load_indices(self):
+        indexed = self._indexed
+        self._addresses = {}
+        self._buttons = array.array('I')
+        self._addr_file = open(self.path + '.addr', 'a+b')
+        self._btn_file = open(self.path + '.btn', 'a+b')
+
+        # Drop anything past what was last
+        # flushed, it gets indexed again below
+        self._addr_file.seek(0)
+        data = self._addr_file.read()
+        keep = 0
+        for addr, record in _ADDR_ENTRY.iter_unpack(data[:len(data) - len(data) % _ADDR_ENTRY.size]):
+            if record >= indexed:
+                break
+            self._addresses.setdefault(addr, array.array('I')).append(record)
+            keep += _ADDR_ENTRY.size
+        self._addr_file.truncate(keep)
+
+        self._btn_file.seek(0)
+        data = self._btn_file.read()
+        self._buttons.frombytes(data[:len(data) - len(data) % _BTN_ENTRY.size])
+        while self._buttons and self._buttons[-1] >= indexed:
+            self._buttons.pop()
+        self._btn_file.truncate(len(self._buttons) * _BTN_ENTRY.size)
+
+        if indexed < self._count:
+            logger.info('Indexing {} records of {}', self._count - indexed, self.path)
+            for record in range(indexed, self._count):
+                t, msg = self.get(record)
+                if msg is not None:
+                    self._index(record, msg, msg.duplicate)
+            self.flush()
+
+    def _write_header(self):
+        _HEADER.pack_into(self._map, 0, _MAGIC, _VERSION, _RECORD.size, self._count, self._indexed)
+
+    def flush(self):
+        if not self._file:
+            return
+        self._addr_file.flush()
+        self._btn_file.flush()
+        self._indexed = self._count
+        self._write_header()
+        self._map.flush()
+
+    def _close_map(self):
+        self._map.close()
+        self._file.close()
+        self._map = None
+        self._file = None
+
+    def close(self):
+        if not self._file:
+            return
+        for port in list(self._ports):
+            self.detach(port)
+        self.flush()
+        self._close_map()
+        self._addr_file.close()
+        self._btn_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _grow(self):
+        self._map.close()
+        self._capacity += self.grow
+        self._file.truncate(_HEADER_SIZE + self._capacity * _RECORD.size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    # ---------------- Recording -----------------
+
+    @property
+    def count(self):
+        return self._count
+
+    def append(self, msg, direction=None, timestamp=None):
+        raw = msg.bytes
+        if direction is None:
+            direction = self.defs[msg.type].direction
+        if len(raw) > 30 or not direction in _DIRECTIONS:
+            return None
+
+        # Times never go backwards in the log (if the clock
+        # does), else the log could not be bisected by time
+        t = timestamp if timestamp is not None else time.time()
+        t = max(t, self._last_time)
+        if self._count == self._capacity:
+            self._grow()
+        record = self._count
+        duplicate = getattr(msg, 'duplicate', False)
+        _RECORD.pack_into(self._map, _HEADER_SIZE + record * _RECORD.size,
+                          t, _DIRECTIONS[direction] | (_DUPLICATE if duplicate else 0), len(raw), raw)
+        self._count += 1
+        self._last_time = t
+        self._write_header()
+        self._index(record, msg, duplicate)
+        return record
+
+    def _index(self, record, msg, duplicate=False):
+        addresses = set()
+        for f in self.defs[msg.type].fields_list:
+            if f.type == message.DataType.ADDRESS and f.name in msg:
+                addresses.add(_pack_address(msg[f.name]))
+        # The to address of an ALL-Link broadcast is just the group
+        if MsgType.from_msg(msg) == MsgType.ALL_LINK_BROADCAST:
+            addresses.discard(_pack_address(msg['toAddress']))
+        for addr in addresses:
+            self._addresses.setdefault(addr, array.array('I')).append(record)
+            self._addr_file.write(_ADDR_ENTRY.pack(addr, record))
+
+        if not duplicate and self.is_button_event(msg):
+            self._buttons.append(record)
+            self._btn_file.write(_BTN_ENTRY.pack(record))
+
+    @staticmethod
+    def is_button_event(msg):
+        if msg.type == 'ButtonEventReport':
+            return True
+        if msg.type != 'StandardMessageReceived':
+            return False
+        return MsgType.from_msg(msg) == MsgType.ALL_LINK_BROADCAST and \
+                    msg['command1'] in BUTTON_COMMANDS
+
+    # Records everything read from (and optionally written to) the port
+    def attach(self, port, writes=False):
+        port.notify_read(self._on_read)
+        if writes:
+            port.notify_write(self._on_write)
+        self._ports[port] = writes
+
+    def detach(self, port):
+        port.stop_notify_read(self._on_read)
+        if self._ports.pop(port):
+            port.stop_notify_write(self._on_write)
+
+    def _on_read(self, msg):
+        self.append(msg, Direction.FROM_MODEM)
+
+    def _on_write(self, msg):
+        self.append(msg, Direction.TO_MODEM)
+
+    # ---------------- Queries -----------------
+
+    def time_of(self, record):
+        return _TIME.unpack_from(self._map, _HEADER_SIZE + record * _RECORD.size)[0]
+
+    # The time a record was seen and its message (None if
+    # no definition matches it anymore)
+    def get(self, record):
+        if record < 0:
+            record += self._count
+        if record < 0 or record >= self._count:
+            raise IndexError('No record {}'.format(record))
+        t, direction, length, raw = _RECORD.unpack_from(self._map, _HEADER_SIZE + record * _RECORD.size)
+        raw = raw[:length]
+        for d in self._by_cmd.get((direction & ~_DUPLICATE, raw[1] if length > 1 else None), ()):
+            if d.length == length and d.matches(raw):
+                msg = message.Msg(d, raw=raw)
+                msg.duplicate = bool(direction & _DUPLICATE)
+                return t, msg
+        return t, None
+
+    def _get_all(self, records):
+        return [self.get(r) for r in records]
+
+    # First index of records (which are in time order) seen at or after t
+    def _bisect(self, records, t, lo=0, hi=None):
+        hi = len(records) if hi is None else hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time_of(records[mid]) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _range(self, records, t1, t2):
+        lo = self._bisect(records, t1) if t1 is not None else 0
+        hi = self._bisect(records, t2, lo) if t2 is not None else len(records)
+        return records[lo:hi]
+
+    # Every (time, message) seen from t1 up to (not including) t2, oldest first
+    def between(self, t1=None, t2=None):
+        return self._get_all(self._range(range(self._count), t1, t2))
+
+    # The last n (time, message)s, oldest first
+    def last(self, n=10):
+        return self._get_all(range(max(self._count - n, 0), self._count))
+
+    # Every (time, message) from t1 up to t2 that has the address in it
+    def for_address(self, address, t1=None, t2=None):
+        records = self._addresses.get(_pack_address(address))
+        if not records:
+            return []
+        return self._get_all(self._range(records, t1, t2))
+
+    # The last n button events (from the device at address), oldest first
+    def button_events(self, n=10, address=None):
+        if address is None:
+            return self._get_all(self._buttons[max(len(self._buttons) - n, 0):])
+        events = []
+        for record in reversed(self._addresses.get(_pack_address(address), ())):
+            if len(events) >= n:
+                break
+            i = bisect.bisect_left(self._buttons, record)
+            if i == len(self._buttons) or self._buttons[i] != record:
+                continue
+            t, msg = self.get(record)
+            if msg is not None and 'fromAddress' in msg and msg['fromAddress'] == address:
+                events.append((t, msg))
+        events.reverse()
+        return events
@@ -1,11 +1,19 @@
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 
 import insteon.io.serial as serial
 
+import asyncio
 import binascii
 import threading
 import base64
 
+# HTTPServer handles one request at a time, which means
+# a single slow poller blocks everyone else. Serve each
+# request on its own thread instead
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
 def make_handler(srv):
     class HubHandler(BaseHTTPRequestHandler):
         def do_HEAD(self):
@@ -85,44 +93,78 @@ def make_handler(srv):
     return HubHandler
 
 class HubServer:
-    def __init__(self, io_conn, port, username, password, bufferlen):
+    def __init__(self, io_conn, port, username, password, bufferlen=40, read_size=64):
         self._io_conn = io_conn
         self._port = port
         self._handler = make_handler(self)
         self._username = username
         self._password = password
+        self._read_size = read_size
+
+        # The index is reported as a position in the hex string in two
+        # hex digits (which is all HubConn reads), so that has to fit
+        if bufferlen < 1 or 2*bufferlen > 0xff:
+            raise ValueError('bufferlen must be between 1 and 127, not {}'.format(bufferlen))
 
+        # The ring is published as an immutable (buffer, pos) snapshot
+        # which the http threads can grab without taking a lock.
+        # The lock only serializes the reader against clear()
         self._buffer_lock = threading.Lock()
-        self._buffer = bytearray(bufferlen)
-        self._buffer_pos = 0
+        self._snapshot = (bytes(bufferlen), 0)
+        self._status = None # (snapshot, status string) of the last status request
+
+        # Writes to the connection go through a separate lock
+        # so that they don't hold up the reader
+        self._write_lock = threading.Lock()
+
+        # The io loop is created by run()
+        self._loop = None
 
     @property
     def buffer(self):
-        with self._buffer_lock:
-            return bytes(self._buffer)
+        return self._snapshot[0]
 
     @property
     def buffer_status(self):
-        with self._buffer_lock:
-            return (self._buffer.hex() + '{:02x}'.format(2*self._buffer_pos)).upper()
+        snapshot = self._snapshot
+        status = self._status
+        if status and status[0] is snapshot:
+            return status[1]
 
+        buf, pos = snapshot
+        text = (buf.hex() + '{:02x}'.format(2*pos)).upper()
+        self._status = (snapshot, text)
+        return text
 
     def write(self, data):
-        with self._buffer_lock:
-            self._io_conn.write(data)
+        loop = self._loop
+        if not loop:
+            raise IOError('Hub server is not running, cannot write')
+        with self._write_lock:
+            asyncio.run_coroutine_threadsafe(self._io_conn.write(data), loop).result()
 
     def read(self, data):
         with self._buffer_lock:
-            for x in data:
-                self._buffer[self._buffer_pos] = x
-                self._buffer_pos = (self._buffer_pos + 1) % len(self._buffer)
+            old, pos = self._snapshot
+            size = len(old)
+            # Only the last size bytes can survive the wrap
+            if len(data) > size:
+                pos = (pos + len(data) - size) % size
+                data = data[-size:]
+
+            buf = bytearray(old)
+            first = min(len(data), size - pos)
+            buf[pos:pos + first] = data[:first]
+            buf[:len(data) - first] = data[first:]
+            self._snapshot = (bytes(buf), (pos + len(data)) % size)
 
     def clear(self):
         with self._buffer_lock:
-            self._buffer = bytearray(len(self._buffer))
-            self._buffer_pos = 0
+            self._snapshot = (bytes(len(self._snapshot[0])), 0)
 
     def run(self):
+        self._loop = asyncio.new_event_loop()
+
         # start the read thread
         reader = threading.Thread(target=self._read_thread)
         reader.start()
@@ -132,8 +174,11 @@ class HubServer:
         self._io_conn.close()
         reader.join()
 
+        self._loop.close()
+        self._loop = None
+
     def _run_http_server(self):
-        httpd = HTTPServer(("", self._port), self._handler)
+        httpd = ThreadingHTTPServer(("", self._port), self._handler)
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
@@ -141,9 +186,16 @@ class HubServer:
         httpd.server_close()
 
     def _read_thread(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._run_reader())
+
+    async def _run_reader(self):
         while self._io_conn.is_open:
-            buf = self._io_conn.read(1)
-            if len(buf) > 0:
+            try:
+                buf = await self._io_conn.read(self._read_size)
+            except EOFError:
+                break
+            if buf:
                 self.read(buf)
 
 def run():
@@ -151,7 +203,7 @@ def run():
     username = 'hub'
     password = 'hubpass'
     print('Server started on port {}'.format(port))
-    srv = HubServer(serial.SerialConn('/dev/ttyUSB0'), port, username, password, 40)
+    srv = HubServer(serial.SerialConn('/dev/ttyUSB0'), port, username, password, 100)
     srv.run()
 
 if __name__ == '__main__':
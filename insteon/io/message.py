@@ -1,5 +1,8 @@
 from enum import Enum
+from collections import OrderedDict
 import struct
+import copy
+import time
 
 class Direction(Enum):
     TO_MODEM = 'TO_MODEM'
@@ -51,18 +54,28 @@ class AckType(Enum):
 # Message behaves like a dictionary
 # with a associated definition
 class Msg:
-    def __init__(self, msg_def, msg=None):
+    # A message can also be made straight from its serialized
+    # form (raw), the fields are only decoded if they are looked at
+    def __init__(self, msg_def, msg=None, raw=None):
         self._def = msg_def
-        self._msg = msg if msg else {} # The message dictionary
+        self._msg = msg if msg else ({} if raw is None else None) # The message dictionary
+        self._raw = raw
+        self.duplicate = False # Set by a DuplicateFilter that is only tagging
+
+    def _fields(self):
+        if self._msg is None:
+            self._msg = self._def.deserialize(self._raw)._msg
+        return self._msg
 
     def __contains__(self, name):
-        return name in self._msg
+        return name in self._fields()
 
     def __getitem__(self, name):
-        return self._msg[name]
+        return self._fields()[name]
 
     def __setitem__(self, name, val):
-        self._msg[name] = val
+        self._fields()[name] = val
+        self._raw = None
 
     def __str__(self):
         if self._def is None:
@@ -78,12 +91,14 @@ class Msg:
     def bytes(self):
         if self._def is None:
             return bytes()
+        elif self._raw is not None:
+            return bytes(self._raw)
         else:
             return self._def.serialize(self)
 
     def copy(self):
         return Msg(self._def,
-                copy.deepcopy(self._msg))
+                copy.deepcopy(self._fields()))
 
 class MsgDecoder:
     def __init__(self, defs = {}, direction=Direction.FROM_MODEM):
@@ -133,3 +148,64 @@ class MsgDecoder:
             # We can't determine anything yet
             break
         return None
+
+# Insteon messages get repeated by every device along the way, so the
+# same message can be heard several times (with different hop counts).
+# The filter spots insteon messages seen before within the time window,
+# only the modem's own replies are never considered duplicates
+class DuplicateFilter:
+    def __init__(self, window=0.5, drop=True):
+        self.window = window
+        self.drop = drop # Drop duplicates rather than just tag them
+        self.seen = 0
+        self.suppressed = 0
+        self._recent = OrderedDict() # key -> time first seen, oldest first
+
+    @staticmethod
+    def key(msg):
+        if msg.type != 'StandardMessageReceived' and msg.type != 'ExtendedMessageReceived':
+            return None
+        key = (msg['fromAddress'], msg['toAddress'], msg['messageFlags'] & 0xF0,
+               msg['command1'], msg['command2'])
+        if msg.type == 'ExtendedMessageReceived':
+            key = key + tuple(msg['userData{}'.format(i)] for i in range(1, 15))
+        return key
+
+    # Returns True if msg is a duplicate and should be dropped, tagging it if not dropping
+    def check(self, msg, now=None):
+        key = DuplicateFilter.key(msg)
+        if key is None:
+            return False
+        now = now if now is not None else time.time()
+
+        # Forget everything outside of the window
+        recent = self._recent
+        while recent:
+            oldest = next(iter(recent.values()))
+            if now - oldest <= self.window:
+                break
+            recent.popitem(last=False)
+
+        self.seen += 1
+        if key in recent:
+            self.suppressed += 1
+            msg.duplicate = True
+            return self.drop
+        recent[key] = now
+        return False
+
+    # A direct message is going out to msg's toAddress, whatever that
+    # device sends back next answers it (e.g. the same ACK as the
+    # last command's) so nothing heard from it so far counts anymore
+    def written(self, msg):
+        if not 'toAddress' in msg or not 'messageFlags' in msg or \
+                msg['messageFlags'] & 0xe0 != MsgType.DIRECT.value:
+            return
+        addr = msg['toAddress']
+        for key in [k for k in self._recent if k[0] == addr]:
+            del self._recent[key]
+
+    def reset(self):
+        self._recent.clear()
+        self.seen = 0
+        self.suppressed = 0
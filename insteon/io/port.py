@@ -1,10 +1,14 @@
 import weakref
 import asyncio
+import inspect
+import itertools
 import traceback
 
 import time
+from enum import Enum
 
 from . import message
+from .admission import RequestRejected
 from .. import util as util
 
 import logbook
@@ -47,6 +51,15 @@ class Request:
         self.responses = []
         self.response = None # set on wait() for convenience so this is always the last wait
 
+        # set by abort() when the request can never complete,
+        # i.e the connection was lost
+        self.error = None
+
+        # filled in by the port when the request is queued
+        self.priority = None
+        self.client = None
+        self.queued_at = None
+
 
     # ------------- Lifetime Management Functions --------------
 
@@ -70,6 +83,23 @@ class Request:
     def fail(self, extra_quiet=0):
         self.failure.set()
 
+    # gives up on the request for good, anyone waiting
+    # on a response gets None back
+    async def abort(self, error=None):
+        self.error = error if error else util.InsteonError('Request aborted')
+        self.failure.set()
+        self.done.set()
+
+        await self.received.acquire()
+        try:
+            self.received.notify_all()
+        finally:
+            self.received.release()
+
+    @property
+    def aborted(self):
+        return self.error is not None
+
     # ---------------- Response Management Functions ------------
 
     # when consume() is called a message
@@ -80,28 +110,30 @@ class Request:
 
     # will eat upto a particular message
     def consume_until(self, msg):
-        for i in range(len(responses)):
-            if responses[i] == msg:
+        for i in range(len(self.responses)):
+            if self.responses[i] == msg:
                 self.responses = self.responses[i + 1:]
+                break
 
-    def wait(self, timeout=0):
+    # both return None on timing out
+    async def wait(self, timeout=0):
         try:
             if timeout > 0:
-                return asyncio.wait_for(self._wait(), timeout)
+                return await asyncio.wait_for(self._wait(), timeout)
             else:
-                return self._wait()
+                return await self._wait()
         except asyncio.TimeoutError:
             self.response = None
             return None
 
-    def wait_until(self, predicate, timeout=0):
+    async def wait_until(self, predicate, timeout=0):
         try:
             if timeout > 0:
-                return asyncio.wait_for(self._wait_until(predicate), timeout)
+                return await asyncio.wait_for(self._wait_until(predicate), timeout)
             else:
-                return self._wait_until(predicate)
+                return await self._wait_until(predicate)
         except asyncio.TimeoutError:
-            print('timed out')
+            logger.trace('timed out')
             self.response = None
             return None
 
@@ -117,18 +149,36 @@ class Request:
                 self.successful.set()
                 return True
             return False 
-        await self.written.wait()
+        if not await self._wait_written():
+            return None
         return await self.wait_until(handle, timeout)
 
+    # Returns False if the request was aborted (or shed) before being written
+    async def _wait_written(self):
+        if not self.written.is_set() and not self.aborted:
+            waits = {asyncio.ensure_future(self.written.wait()),
+                     asyncio.ensure_future(self.done.wait())}
+            try:
+                await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for w in waits:
+                    w.cancel()
+        return self.written.is_set()
+
     # The underlying wait functions
     # are wrapped above to have timeouts
     async def _wait(self):
         if len(self.responses) > 0:
             return self.responses[0]
+        if self.aborted:
+            return None
 
         await self.received.acquire()
         try:
             await self.received.wait()
+            if not self.responses:
+                self.response = None
+                return None
             self.response = self.responses[0]
             return self.response
         finally:
@@ -137,16 +187,27 @@ class Request:
     async def _wait_until(self, predicate):
         for r in self.responses:
             if predicate(r):
+                self.response = r
                 return r
+        checked = len(self.responses)
+
+        if self.aborted:
+            return None
 
         await self.received.acquire()
         try:
             while True:
                 await self.received.wait()
-                resp = self.responses[-1]
-                if predicate(resp):
-                    self.response = resp
-                    return resp
+                if self.aborted:
+                    self.response = None
+                    return None
+                # several messages can come in before we get woken up
+                new = self.responses[min(checked, len(self.responses)):]
+                checked = len(self.responses)
+                for resp in new:
+                    if predicate(resp):
+                        self.response = resp
+                        return resp
         finally:
             self.received.release()
 
@@ -160,18 +221,129 @@ class Request:
         finally:
             self.received.release()
 
+class ConnectionEvent(Enum):
+    CONNECTED = 'CONNECTED'
+    DISCONNECTED = 'DISCONNECTED'
+
+# What a subscription does with a message when its queue is full
+class Overflow(Enum):
+    BLOCK = 'BLOCK' # hold up the reader until there is room
+    DROP_OLDEST = 'DROP_OLDEST'
+    DROP_NEWEST = 'DROP_NEWEST'
+
+"""
+A subscription is a stream of the messages read by the port
+(which pass the filter), to be consumed with
+async for msg in subscription:
+    ...
+Messages wait in a bounded queue until they are consumed, so a slow
+consumer only holds up the reader if its overflow policy is BLOCK.
+"""
+class Subscription:
+    def __init__(self, port, filter=None, maxsize=100, overflow=Overflow.DROP_OLDEST):
+        self._port = port
+        self.filter = filter
+        self.overflow = overflow
+        self.dropped = 0
+        self.closed = False
+        self._queue = asyncio.Queue(maxsize)
+        self._blocked = None # The put holding up the reader
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed and self._queue.empty():
+            raise StopAsyncIteration
+        msg = await self._queue.get()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
+
+    # The next message, None if the subscription
+    # closes or there is nothing within the timeout
+    async def get(self, timeout=None):
+        try:
+            return await asyncio.wait_for(self.__anext__(), timeout)
+        except (asyncio.TimeoutError, StopAsyncIteration):
+            return None
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._port._unsubscribe(self)
+        if self._blocked:
+            self._blocked.cancel()
+        # Wake up a consumer waiting on an empty queue, with anything
+        # queued the consumer stops once it has had all of it
+        if not self._queue.full():
+            self._queue.put_nowait(None)
+
+    async def _offer(self, msg):
+        if self.filter:
+            try:
+                if not self.filter(msg):
+                    return
+            except Exception as e:
+                # A broken filter shouldn't take the reader down with it
+                logger.error('Subscription filter failed on {}: {}', msg, e)
+                return
+        if not self._queue.full():
+            self._queue.put_nowait(msg)
+        elif self.overflow == Overflow.BLOCK:
+            self._blocked = asyncio.ensure_future(self._queue.put(msg))
+            try:
+                await self._blocked
+            except asyncio.CancelledError:
+                # Only swallow it if it was close() that cancelled the put
+                if not self.closed:
+                    raise
+            finally:
+                self._blocked = None
+        elif self.overflow == Overflow.DROP_OLDEST:
+            self._queue.get_nowait()
+            self._queue.put_nowait(msg)
+            self.dropped += 1
+        else:
+            self.dropped += 1
+
 class Port:
-    def __init__(self, definitions={}):
+    # dedup, if given, is a message.DuplicateFilter which repeated
+    # messages are run through before they are dispatched (it is told
+    # about every message written so a device's answer to a new
+    # command is never taken for a repeat of the last one)
+    def __init__(self, definitions={}, dedup=None):
         self.defs = definitions
+        self.dedup = dedup
 
         self._queue = asyncio.PriorityQueue()
+        # Breaks ties between requests of the same priority
+        # so they are written in the order they were queued
+        self._queue_seq = itertools.count()
 
         # Requests that aren't done yet
         # there can be multiple running concurrently at any given time
         self._open_requests = []
 
+        # The request the writer is currently working on
+        # as its (priority, seq, request) queue entry
+        self._inflight = None
+
         self._write_handlers = []
         self._read_handlers = []
+        self._connection_handlers = []
+        self._subscriptions = []
 
         self._watch_write = lambda m: logger.info(f'wrote: {m}')
         self._watch_read = lambda m: logger.info(f'read: {m}')
@@ -179,13 +351,33 @@ class Port:
         # if using the start, stop api this will be set
         self._task = None
 
-    def start(self, conn, loop=None):
+        # Set while tracing requests (see start_tracing())
+        self.tracer = None
+
+        # An admission.Admission limiting what can be queued
+        self.admission = None
+
+    """ If a factory is given the port is supervised: whenever the connection is lost
+        a new one is made by calling factory() (which may be a coroutine), backing off
+        between min_backoff and max_backoff seconds while that fails. Requests that were
+        not written yet stay queued. The request being written when the connection dropped
+        is requeued if retry_inflight is set and aborted otherwise, the remaining open requests
+        are aborted. conn can be None in which case the first connection also comes from the factory """
+    def start(self, conn, loop=None, factory=None, min_backoff=0.5, max_backoff=30,
+                    retry_inflight=True):
         if not loop:
             loop = asyncio.get_event_loop()
         self._open_requests.clear()
         self._queue = asyncio.PriorityQueue() # clear the queue
-
-        self._task = loop.create_task(self._run(conn))
+        self._inflight = None
+        if self.admission:
+            self.admission.clear()
+
+        if factory:
+            self._task = loop.create_task(self._supervise(conn, factory, min_backoff,
+                                                          max_backoff, retry_inflight))
+        else:
+            self._task = loop.create_task(self._run(conn))
         return self._task
 
     def notify_write(self, h):
@@ -200,6 +392,39 @@ class Port:
     def stop_notify_read(self, h):
         self._read_handlers.remove(h)
 
+    # Returns a Subscription to the messages read that pass the filter
+    def subscribe(self, filter=None, maxsize=100, overflow=Overflow.DROP_OLDEST):
+        sub = Subscription(self, filter, maxsize, overflow)
+        self._subscriptions.append(sub)
+        return sub
+
+    def _unsubscribe(self, sub):
+        if sub in self._subscriptions:
+            self._subscriptions.remove(sub)
+
+    # handlers are called with a ConnectionEvent and the connection
+    def notify_connection(self, h):
+        self._connection_handlers.append(h)
+
+    def stop_notify_connection(self, h):
+        self._connection_handlers.remove(h)
+
+    # Records a timeline of every request from now on
+    # (the last max_requests are kept), returns the tracer
+    def start_tracing(self, max_requests=1000):
+        from .trace import RequestTracer
+        if not self.tracer:
+            self.tracer = RequestTracer(max_requests)
+            self.notify_read(self.tracer.read)
+        return self.tracer
+
+    def stop_tracing(self):
+        tracer = self.tracer
+        if tracer:
+            self.stop_notify_read(tracer.read)
+            self.tracer = None
+        return tracer
+
     def start_watching(self):
         self.notify_write(self._watch_write)
         self.notify_read(self._watch_read)
@@ -219,23 +444,154 @@ class Port:
 
     """ Write returns a request object through which the 
         caller can get access to a queue containing all future messages that have been sent """
-    def write(self, msg, priority=1, retries=5, timeout=0.1, quiet=0.1):
+    def write(self, msg, priority=1, retries=5, timeout=0.1, quiet=0.1, client=None):
         req = Request(msg, retries, timeout, quiet)
-        self._queue.put_nowait((priority, req))
+        req.priority = priority
+        req.client = client
+        req.queued_at = time.time()
+        if self.admission:
+            # raises RequestRejected if it can't be queued
+            self.admission.admit(req)
+        if self.tracer:
+            self.tracer.queued(req)
+        self._queue.put_nowait((priority, next(self._queue_seq), req))
         return req
 
+    # Takes every request still waiting to be written off the queue
+    # (e.g. to hand them to another port), returns them in queue order
+    def take_queued(self):
+        reqs = []
+        while not self._queue.empty():
+            _, _, req = self._queue.get_nowait()
+            if self.admission and not req.aborted:
+                self.admission.taken(req)
+            if not req.aborted:
+                reqs.append(req)
+        return reqs
+
+    # Queues a request taken off another port, with its original
+    # priority. Raises RequestRejected if admission turns it away
+    def requeue(self, req):
+        if self.admission:
+            self.admission.admit(req)
+        if self.tracer:
+            self.tracer.queued(req)
+        self._queue.put_nowait((req.priority, next(self._queue_seq), req))
+
+    # Number of requests waiting to be written, not counting the ones
+    # that were aborted (e.g. shed) and are only waiting to be thrown away
+    @property
+    def queued(self):
+        return sum(1 for _, _, req in self._queue._queue if not req.aborted)
+
     async def _run(self, conn):
         try:
-            await asyncio.gather(self._run_writer(conn), self._run_reader(conn))
+            await self._run_conn(conn)
         except asyncio.CancelledError:
             raise
         finally:
             pass
 
+        # Without a supervisor nothing is ever going to
+        # be written again so give up on everything
+        error = util.InsteonError('Connection lost')
+        await self._recover(False, error)
+        while not self._queue.empty():
+            _, _, req = self._queue.get_nowait()
+            await req.abort(error)
+
+    async def _supervise(self, conn, factory, min_backoff, max_backoff, retry_inflight):
+        backoff = min_backoff
+        while True:
+            if not conn:
+                try:
+                    conn = factory()
+                    if inspect.isawaitable(conn):
+                        conn = await conn
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning('Failed to connect ({}), retrying in {}s', e, backoff)
+                    await asyncio.sleep(backoff)
+                    backoff = min(2*backoff, max_backoff)
+                    continue
+
+            self._notify_connection(ConnectionEvent.CONNECTED, conn)
+            connected = time.time()
+            await self._run_conn(conn)
+            logger.warning('Connection lost')
+
+            # recover first so the handlers see what is still queued
+            await self._recover(retry_inflight, util.InsteonError('Connection lost'))
+            self._notify_connection(ConnectionEvent.DISCONNECTED, conn)
+            try:
+                conn.close()
+            except Exception:
+                pass
+            conn = None
+
+            # A connection which drops straight away
+            # shouldn't have us reconnecting in a tight loop
+            if time.time() - connected > max_backoff:
+                backoff = min_backoff
+            await asyncio.sleep(backoff)
+            backoff = min(2*backoff, max_backoff)
+
+    # Runs until either side of the connection fails
+    async def _run_conn(self, conn):
+        tasks = [asyncio.ensure_future(self._run_writer(conn)),
+                 asyncio.ensure_future(self._run_reader(conn))]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.wait(tasks)
+
+    # Sorts out the requests that were in progress
+    # when the connection went down
+    async def _recover(self, retry_inflight, error):
+        requeued = None
+        if self._inflight:
+            pri, seq, req = self._inflight
+            self._inflight = None
+            if not req.successful.is_set() and \
+                    (retry_inflight or not req.written.is_set()):
+                # put it back with its original place in line
+                req.written.clear()
+                req.failure.clear()
+                self._queue.put_nowait((pri, seq, req))
+                requeued = req
+
+        for ref in self._open_requests:
+            req = ref()
+            if req and req is not requeued:
+                await req.abort(error)
+        self._open_requests.clear()
+
+    def _notify_connection(self, event, conn):
+        handlers = list(self._connection_handlers)
+        for h in handlers:
+            h(event, conn)
+
     async def _run_writer(self, conn):
         try:
             while True:
-                pri, req = await self._queue.get()
+                entry = await self._queue.get()
+                pri, _, req = entry
+                tracer = self.tracer
+                if self.admission and not req.aborted:
+                    self.admission.taken(req)
+                    if self.admission.expired(req):
+                        await req.abort(RequestRejected('Request shed after waiting {:.1f}s in the queue'.format(
+                                                            time.time() - req.queued_at)))
+                if req.aborted:
+                    if tracer:
+                        tracer.finished(req)
+                    continue
+                self._inflight = entry
+                if tracer:
+                    tracer.picked(req, conn)
                 
                 # Put a weak reference to the request in the open requests list
                 self._open_requests.append(weakref.ref(req))
@@ -247,8 +603,14 @@ class Port:
                     req.failure.clear()
 
                     # do the writing... (synchronously?)
+                    if self.dedup:
+                        self.dedup.written(req.message)
+                    if tracer:
+                        tracer.writing(req)
                     await conn.write(req.message.bytes)
                     await conn.flush()
+                    if tracer:
+                        tracer.written(req)
 
                     # set that the request has been written
                     req.written.set()
@@ -258,29 +620,36 @@ class Port:
                     for h in handlers:
                         h(req.message)
 
+                    # wait for either the continue event to trigger
+                    # or the resend condition
+                    waitables = {asyncio.ensure_future(req.successful.wait()),
+                                 asyncio.ensure_future(req.failure.wait())}
                     try:
-                        # wait for either the continue event to trigger
-                        # or the resend condition
-                        waitables = {req.successful.wait(), req.failure.wait()}
-                        _, pending = await asyncio.wait_for(asyncio.wait(waitables, 
-                                                        return_when=asyncio.FIRST_COMPLETED), 
-                                                        req.timeout)
+                        done, _ = await asyncio.wait(waitables, timeout=req.timeout,
+                                                        return_when=asyncio.FIRST_COMPLETED)
+                    finally:
                         # cancel any pending waits
-                        for w in pending:
+                        for w in waitables:
                             w.cancel()
 
-                        if req.successful.is_set():
-                            break
-                    except asyncio.CancelledError:
-                        raise
-                    except asyncio.TimeoutError:
+                    if tracer:
+                        tracer.replied(req, 'echo' if req.successful.is_set() else \
+                                            ('failure' if done else 'timeout'))
+                    if req.successful.is_set():
+                        break
+                    if not done:
                         # We timed out so set the failure flag ourselves
                         req.failure.set()
 
                 # Wait for the mandatory quiet time after the request
+                if tracer:
+                    tracer.quiet(req)
                 await asyncio.sleep(req.quiet_time)
-        except EOFError:
-            pass
+                if tracer:
+                    tracer.finished(req)
+                self._inflight = None
+        except (EOFError, OSError, util.InsteonError) as e:
+            logger.error('Write failed: {}', e)
         finally:
             pass
 
@@ -290,12 +659,10 @@ class Port:
         try:
             while True:
                 try:
-                    buf = await conn.read(1)
+                    # the connection hands back everything it has available
+                    buf = await conn.read()
                     if buf is None:
                         raise EOFError()
-                    msg = decoder.decode(buf)
-                    if not msg:
-                        continue
                 except asyncio.CancelledError:
                     raise
                 except TypeError:
@@ -306,18 +673,23 @@ class Port:
                     logger.error(str(e))
                     continue
 
-                # notify all the open requests
-                for ref in self._open_requests:
-                    req = ref()
-                    if not req:
-                        self._open_requests.remove(ref)
-                    else:
-                        await req.process(msg)
-
-                # notify all the handlers
-                handlers = list(self._read_handlers)
-                for h in handlers:
-                    h(msg)
+                # a single read can contain several messages, one that
+                # fails to decode doesn't cost the ones before it
+                msgs = []
+                try:
+                    msg = decoder.decode(buf)
+                    while msg:
+                        msgs.append(msg)
+                        msg = decoder.decode(bytes())
+                except TypeError:
+                    raise
+                except Exception as e:
+                    logger.error(str(e))
+
+                for msg in msgs:
+                    if self.dedup and self.dedup.check(msg):
+                        continue
+                    await self._dispatch(msg)
         except EOFError:
             pass
         except asyncio.CancelledError:
@@ -326,3 +698,21 @@ class Port:
             traceback.print_exc()
         finally:
             pass
+
+    async def _dispatch(self, msg):
+        # notify all the open requests
+        for ref in list(self._open_requests):
+            req = ref()
+            if not req:
+                self._open_requests.remove(ref)
+            else:
+                await req.process(msg)
+
+        # notify all the handlers
+        handlers = list(self._read_handlers)
+        for h in handlers:
+            h(msg)
+
+        # and queue it up for the subscribers
+        for sub in list(self._subscriptions):
+            await sub._offer(msg)
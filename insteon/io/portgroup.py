@@ -0,0 +1,210 @@
+import asyncio
+
+from .message import MsgType, DuplicateFilter
+from .port import ConnectionEvent
+from .admission import RequestRejected
+
+import logbook
+logger = logbook.Logger(__name__)
+
+"""
+A PortGroup spreads traffic over several modems, each with its own Port
+(and so its own writer loop). It looks enough like a Port that it can be
+handed to anything which just calls write() and notify_read().
+
+Messages addressed to a device go to the modem that is best placed to
+reach it. That is either configured through assign() or learned from the
+direct ACKs each modem gets back from the device and the number of hops
+the device's messages take to reach each modem. Everything else goes to
+the least busy modem. Modems which lose their connection are skipped until
+they come back.
+
+A message heard by several modems is read once from each of them. The
+group's read handlers only get the first copy, the others are dropped by
+the group's DuplicateFilter (pass dedup=None to get every copy).
+"""
+
+# What one port knows about reaching one address
+class RouteStats:
+    def __init__(self):
+        self.attempts = 0
+        self.acks = 0
+        self.nacks = 0
+        self.hops = None # Running average of hops taken
+
+    def record_hops(self, hops, weight=0.2):
+        if self.hops is None:
+            self.hops = hops
+        else:
+            self.hops = (1 - weight)*self.hops + weight*hops
+
+    @property
+    def score(self):
+        # Laplace smoothed ACK rate, penalized a little
+        # for every hop the messages need
+        rate = (self.acks + 1) / (self.attempts + 2)
+        hops = self.hops if self.hops is not None else 1.5
+        return rate - 0.1*hops
+
+class PortGroup:
+    def __init__(self, ports=[], dedup=True):
+        self.ports = []
+        self.defs = {}
+        self.dedup = DuplicateFilter() if dedup is True else dedup
+
+        self._down = set()
+        self._assigned = {}
+        self._stats = {} # (port index, address) -> RouteStats
+
+        self._write_handlers = []
+        self._read_handlers = []
+
+        for p in ports:
+            self.add(p)
+
+    def add(self, port):
+        idx = len(self.ports)
+        self.ports.append(port)
+        if not self.defs:
+            self.defs = port.defs
+
+        port.notify_read(lambda m: self._on_read(idx, m))
+        port.notify_write(lambda m: self._on_write(idx, m))
+        port.notify_connection(lambda e, c: self._on_connection(idx, e))
+        return idx
+
+    # Each port reconnects through its own factory (factories, one per port)
+    # so a lost modem is never replaced by a second connection to another one
+    def start(self, conns, loop=None, factories=None, **kwargs):
+        if len(conns) != len(self.ports):
+            raise ValueError('Need one connection per port')
+        if 'factory' in kwargs:
+            raise ValueError('Ports in a group need a factory each, pass factories')
+        if factories is None:
+            factories = [None] * len(self.ports)
+        elif len(factories) != len(self.ports):
+            raise ValueError('Need one factory per port')
+        return [p.start(c, loop, factory=f, **kwargs)
+                    for p, c, f in zip(self.ports, conns, factories)]
+
+    async def stop(self):
+        await asyncio.gather(*[p.stop() for p in self.ports])
+
+    # Number of requests waiting to be written on all the ports
+    @property
+    def queued(self):
+        return sum(p.queued for p in self.ports)
+
+    def notify_write(self, h):
+        self._write_handlers.append(h)
+
+    def notify_read(self, h):
+        self._read_handlers.append(h)
+
+    def stop_notify_write(self, h):
+        self._write_handlers.remove(h)
+
+    def stop_notify_read(self, h):
+        self._read_handlers.remove(h)
+
+    # ---------------- Routing -----------------
+
+    # Pins an address to a particular port (by index),
+    # None goes back to learned routing
+    def assign(self, address, port_idx):
+        if port_idx is None:
+            self._assigned.pop(address, None)
+        else:
+            self._assigned[address] = port_idx
+
+    def stats(self, port_idx, address):
+        key = (port_idx, address)
+        if not key in self._stats:
+            self._stats[key] = RouteStats()
+        return self._stats[key]
+
+    @property
+    def available(self):
+        return [i for i in range(len(self.ports)) if not i in self._down]
+
+    def route(self, address=None):
+        candidates = self.available
+        if not candidates:
+            # Nothing is up, queue on everything equally
+            # and let the supervisors sort it out
+            candidates = list(range(len(self.ports)))
+        if not candidates:
+            raise ValueError('No ports in group')
+
+        if address is not None:
+            assigned = self._assigned.get(address)
+            if assigned is not None and assigned in candidates:
+                return assigned
+
+            if any((i, address) in self._stats for i in candidates):
+                # Ports we know nothing about get the score of a fresh
+                # RouteStats so they still get tried, ties go to the least busy
+                fresh = RouteStats()
+                return max(candidates, key=lambda i: (self._stats.get((i, address), fresh).score,
+                                                      -self.ports[i].queued))
+
+        return min(candidates, key=lambda i: self.ports[i].queued)
+
+    def write(self, msg, priority=1, retries=5, timeout=0.1, quiet=0.1, client=None):
+        address = msg['toAddress'] if 'toAddress' in msg else None
+        idx = self.route(address)
+        return self.ports[idx].write(msg, priority, retries, timeout, quiet, client)
+
+    # --------------- Learning ----------------
+
+    def _on_write(self, idx, msg):
+        if 'toAddress' in msg and MsgType.from_msg(msg) == MsgType.DIRECT:
+            self.stats(idx, msg['toAddress']).attempts += 1
+        if self.dedup:
+            self.dedup.written(msg)
+
+        for h in list(self._write_handlers):
+            h(msg)
+
+    def _on_read(self, idx, msg):
+        if 'fromAddress' in msg and 'messageFlags' in msg:
+            flags = msg['messageFlags']
+            stats = self.stats(idx, msg['fromAddress'])
+            stats.record_hops((flags & 0x03) - ((flags >> 2) & 0x03))
+
+            msg_type = MsgType.from_value(flags)
+            if msg_type == MsgType.ACK_OF_DIRECT:
+                stats.acks += 1
+            elif msg_type == MsgType.NACK_OF_DIRECT:
+                stats.nacks += 1
+
+        # The same message heard through another modem
+        if self.dedup and self.dedup.check(msg):
+            return
+
+        for h in list(self._read_handlers):
+            h(msg)
+
+    def _on_connection(self, idx, event):
+        if event == ConnectionEvent.CONNECTED:
+            self._down.discard(idx)
+        else:
+            logger.warning('Port {} in group went down', idx)
+            self._down.add(idx)
+            if self.available:
+                self._fail_over(idx)
+
+    # Moves everything waiting on a dead port over to the others
+    def _fail_over(self, idx):
+        moved = 0
+        for req in self.ports[idx].take_queued():
+            msg = req.message
+            target = self.ports[self.route(msg['toAddress'] if 'toAddress' in msg else None)]
+            try:
+                target.requeue(req)
+            except RequestRejected as e:
+                asyncio.ensure_future(req.abort(e))
+                continue
+            moved += 1
+        if moved:
+            logger.info('Moved {} requests off port {}', moved, idx)
@@ -1,6 +1,7 @@
 import logbook
 logger = logbook.Logger(__name__)
 
+import asyncio
 import traceback
 
 from ..util import InsteonError
@@ -17,6 +18,12 @@ class SerialConn:
                     inter_byte_timeout=None):
         self._name = port
         self._port = None
+
+        self._bytes_read = 0
+        self._bytes_written = 0
+
+        self._write_buffer = bytearray()
+        self._write_future = None
         try:
             import aioserial
             import sys
@@ -59,31 +66,102 @@ class SerialConn:
         except:
             self._port = None
 
-    async def read(self, size=1):
+    @property
+    def bytes_read(self):
+        return self._bytes_read
+
+    @property
+    def bytes_written(self):
+        return self._bytes_written
+
+    # Read everything currently available (upto size bytes if given),
+    # waiting until at least one byte has arrived
+    async def read(self, size=None):
         try:
             if not self.is_open:
                 return 
-            return await self._port.read_async(size)
+            data = self._read_available(size)
+            while not data:
+                data = await self._wait_readable()
+                if not self.is_open:
+                    return
+                if not data:
+                    data = self._read_available(size)
+            self._bytes_read += len(data)
+            return data
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             raise EOFError()
             #self.close()
             #raise InsteonError('Error reading from serial port {}'.format(self._name))
 
+    # Writes issued during the same loop iteration are
+    # collected and written out together
     async def write(self, data):
+        if not self.is_open:
+            return
+        self._write_buffer.extend(data)
+        if not self._write_future:
+            loop = asyncio.get_event_loop()
+            self._write_future = loop.create_future()
+            loop.call_soon(self._write_pending)
+        future = self._write_future
+        await asyncio.shield(future)
+        return len(data)
+
+    # Pushes anything that has been buffered out to the port
+    # without waiting for the end of the loop iteration
+    async def flush(self):
+        if self._write_future:
+            future = self._write_future
+            self._write_pending()
+            await asyncio.shield(future)
+
+    def _read_available(self, size):
+        waiting = self._port.in_waiting
+        if not waiting:
+            return bytes()
+        return self._port.read(min(waiting, size) if size else waiting)
+
+    async def _wait_readable(self):
+        loop = asyncio.get_event_loop()
+        fd = None
         try:
-            if not self.is_open:
-                return
-            return await self._port.write_async(data)
-        except AssertionError:
-            raise EOFError()
+            fd = self._port.fileno()
         except Exception:
-            raise InsteonError('Error writing to serial port {}'.format(self._name))
+            pass
 
-    async def flush(self):
-        return
+        if fd is None:
+            # Not a posix port, so hop through the executor
+            # for the first byte, whatever comes after it
+            # will be picked up by the next read
+            return await self._port.read_async(1)
+
+        readable = loop.create_future()
+        loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(fd)
+        return None
+
+    def _write_pending(self):
+        future = self._write_future
+        if not future:
+            return
+        self._write_future = None
+        data = bytes(self._write_buffer)
+        self._write_buffer.clear()
         try:
             if not self.is_open:
-                return
-            self._port.flush()
-        except Exception as e:
-            raise InsteonError('Error writing to port {}'.format(port))
+                raise EOFError()
+            self._port.write(data)
+            self._bytes_written += len(data)
+            future.set_result(None)
+        except EOFError as e:
+            future.set_exception(e)
+        except AssertionError:
+            future.set_exception(EOFError())
+        except Exception:
+            future.set_exception(InsteonError('Error writing to serial port {}'.format(self._name)))
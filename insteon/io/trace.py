@@ -0,0 +1,188 @@
+import collections
+import itertools
+import json
+import time
+import weakref
+
+from .message import MsgType
+
+"""
+Records what happens to every request going through a Port and exports
+it in the Chrome trace event format (load the file in chrome://tracing or
+ui.perfetto.dev).
+
+Each request shows up as a span on the track of the device it was sent
+to (the modem for modem commands), under the connection it went out on,
+broken down into the time spent queued, writing, waiting for the modem's
+echo (for every try) and the quiet time afterwards. The direct ACK from
+the device is an instant event on the same track.
+
+Only the last max_requests finished requests are kept.
+"""
+
+class RequestTrace:
+    def __init__(self, req, now):
+        msg = req.message
+        self.name = msg.type
+        self.address = msg['toAddress'] if 'toAddress' in msg else None
+        self.direct = self.address is not None and MsgType.from_msg(msg) == MsgType.DIRECT
+        self.command = (msg['command1'], msg['command2']) if 'command1' in msg else None
+        self.connection = None
+
+        self.queued = now
+        self.picked = None
+        self.tries = [] # [write start, write end, echo/failure/timeout time, outcome]
+        self.quiet = None # Start of the quiet time
+        self.done = None
+        self.ack = None # (time, 'ACK' or 'NACK')
+
+class RequestTracer:
+    def __init__(self, max_requests=1000):
+        self.max_requests = max_requests
+        self._start = time.perf_counter()
+        self._active = {} # id(request) -> (weakref to the request, RequestTrace)
+        self._finished = collections.deque(maxlen=max_requests)
+        self._connections = {} # id(conn) -> label
+        self._conn_ids = itertools.count(1)
+
+    def _now(self):
+        return time.perf_counter()
+
+    # The finished requests, oldest first
+    @property
+    def requests(self):
+        return list(self._finished)
+
+    def clear(self):
+        self._active.clear()
+        self._finished.clear()
+
+    # ---------------- Recording (called by the port) -----------------
+
+    def _label(self, conn):
+        key = id(conn)
+        if not key in self._connections:
+            self._connections[key] = '{} #{}'.format(type(conn).__name__, next(self._conn_ids))
+        return self._connections[key]
+
+    def queued(self, req):
+        key = id(req)
+        # Requests that never make it to finished() (aborted while
+        # being written, moved to another port, ...) are forgotten
+        # once nothing holds on to them anymore
+        def forget(ref):
+            entry = self._active.get(key)
+            if entry and entry[0] is ref:
+                del self._active[key]
+        self._active[key] = (weakref.ref(req, forget), RequestTrace(req, self._now()))
+
+    def _trace(self, req):
+        entry = self._active.get(id(req))
+        return entry[1] if entry and entry[0]() is req else None
+
+    # The writer took the request off the queue to write to conn
+    def picked(self, req, conn):
+        t = self._trace(req)
+        if t:
+            t.picked = self._now()
+            t.connection = self._label(conn)
+
+    def writing(self, req):
+        t = self._trace(req)
+        if t:
+            t.tries.append([self._now(), None, None, None])
+
+    def written(self, req):
+        t = self._trace(req)
+        if t and t.tries:
+            t.tries[-1][1] = self._now()
+
+    # outcome is 'echo', 'failure' or 'timeout'
+    def replied(self, req, outcome):
+        t = self._trace(req)
+        if t and t.tries:
+            t.tries[-1][2] = self._now()
+            t.tries[-1][3] = outcome
+
+    def quiet(self, req):
+        t = self._trace(req)
+        if t:
+            t.quiet = self._now()
+
+    def finished(self, req):
+        t = self._trace(req)
+        if t:
+            del self._active[id(req)]
+            t.done = self._now()
+            self._finished.append(t)
+
+    def read(self, msg):
+        if not 'fromAddress' in msg or not 'messageFlags' in msg:
+            return
+        msg_type = MsgType.from_msg(msg)
+        if msg_type != MsgType.ACK_OF_DIRECT and msg_type != MsgType.NACK_OF_DIRECT:
+            return
+        now = self._now()
+        # The ACK belongs to the latest written direct request to that device
+        active = (t for _, t in self._active.values())
+        candidates = [t for t in itertools.chain(active, reversed(self._finished))
+                        if t.direct and t.ack is None and t.tries and t.address == msg['fromAddress']]
+        if candidates:
+            t = max(candidates, key=lambda t: t.tries[0][0])
+            t.ack = (now, 'ACK' if msg_type == MsgType.ACK_OF_DIRECT else 'NACK')
+
+    # ---------------- Export -----------------
+
+    def _us(self, t):
+        return round((t - self._start) * 1e6, 1)
+
+    @property
+    def events(self):
+        events = []
+        pids = {}
+        tids = {}
+
+        def track(t):
+            conn = t.connection if t.connection else 'queued'
+            if not conn in pids:
+                pids[conn] = len(pids) + 1
+                events.append({'name': 'process_name', 'ph': 'M', 'pid': pids[conn],
+                               'args': {'name': conn}})
+            device = t.address.human if t.address is not None else 'modem'
+            key = (conn, device)
+            if not key in tids:
+                tids[key] = len(tids) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': pids[conn],
+                               'tid': tids[key], 'args': {'name': device}})
+            return pids[conn], tids[key]
+
+        def span(name, pid, tid, start, end, args=None):
+            if start is None or end is None:
+                return
+            e = {'name': name, 'cat': 'port', 'ph': 'X', 'pid': pid, 'tid': tid,
+                 'ts': self._us(start), 'dur': round(max(end - start, 0) * 1e6, 1)}
+            if args:
+                e['args'] = args
+            events.append(e)
+
+        for t in self._finished:
+            pid, tid = track(t)
+            args = {'tries': len(t.tries)}
+            if t.command:
+                args['command'] = '{:02x} {:02x}'.format(*t.command)
+            if t.ack and t.tries:
+                args['ack_ms'] = round((t.ack[0] - t.tries[0][1 if t.tries[0][1] else 0]) * 1e3, 1)
+            span(t.name, pid, tid, t.queued, t.done, args)
+            span('queued', pid, tid, t.queued, t.picked)
+            for i, (start, written, replied, outcome) in enumerate(t.tries):
+                span('write' if i == 0 else 'retry {}'.format(i), pid, tid, start, written)
+                span(outcome if outcome else 'reply', pid, tid, written, replied)
+            span('quiet', pid, tid, t.quiet, t.done)
+            if t.ack:
+                events.append({'name': t.ack[1], 'cat': 'port', 'ph': 'i', 's': 't',
+                               'pid': pid, 'tid': tid, 'ts': self._us(t.ack[0])})
+        return events
+
+    def export(self, filename):
+        with open(filename, 'w') as out:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, out)
@@ -6,20 +6,33 @@ import inspect
 # CRC stuff
 
 def calc_simple_crc(data):
-    return (~(sum(data)) + 1) & 0xFF
+    return (-sum(data)) & 0xFF
+
+# The i2CS checksum, a 16 bit shift register fed a bit at a time
+# (low bit first) with feedback from bits 15, 14, 12 and 3
+def _long_crc_bits(crc, b):
+    for _ in range(8):
+        fb = b & 0x01
+        fb = fb ^ 0x01 if (crc & 0x8000) else fb
+        fb = fb ^ 0x01 if (crc & 0x4000) else fb
+        fb = fb ^ 0x01 if (crc & 0x1000) else fb
+        fb = fb ^ 0x01 if (crc & 0x0008) else fb
+        crc = ((crc << 1) | fb) & 0xFFFF
+        b = b >> 1
+    return crc
+
+# The register only ever xors bits together, so the effect of a byte
+# is the xor of the effects of the register's high byte, its low byte and
+# the data byte, each of which can be looked up
+_LONG_CRC_HI = [_long_crc_bits(i << 8, 0) for i in range(256)]
+_LONG_CRC_LO = [_long_crc_bits(i, 0) for i in range(256)]
+_LONG_CRC_DATA = [_long_crc_bits(0, i) for i in range(256)]
 
 def calc_long_crc(data):
-    crc = int(0);
-    for loop in xrange(0, len(bytes)):
-            b = bytes[loop] & 0xFF
-            for bit in xrange(0, 8):
-                    fb = b & 0x01
-                    fb = fb ^ 0x01 if (crc & 0x8000) else fb
-                    fb = fb ^ 0x01 if (crc & 0x4000) else fb
-                    fb = fb ^ 0x01 if (crc & 0x1000) else fb
-                    fb = fb ^ 0x01 if (crc & 0x0008) else fb
-                    crc = ((crc << 1) | fb) & 0xFFFF;
-                    b = b >> 1
+    crc = 0
+    hi, lo, dat = _LONG_CRC_HI, _LONG_CRC_LO, _LONG_CRC_DATA
+    for b in data:
+        crc = hi[crc >> 8] ^ lo[crc & 0xFF] ^ dat[b & 0xFF]
     return crc
 
 # A custom insteon error type
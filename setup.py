@@ -41,7 +41,8 @@ setup(
     install_requires=['aioserial','logbook','setuptools'],  # Optional
     extras_require = {  # Optional
         'dev': [],
-        'test': []
+        'test': [],
+        'capture': ['numpy']
     },
 
     package_data = {  # For in-package data files